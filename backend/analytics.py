@@ -0,0 +1,121 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+ANALYTICS_ENABLED = os.getenv('ANALYTICS_ENABLED', 'true').lower() == 'true'
+# Width of a usage rollup bucket; hourly by default
+USAGE_BUCKET_SECONDS = int(os.getenv('USAGE_BUCKET_SECONDS', 3600))
+USAGE_GROUPS = ('user', 'model', 'provider', 'bucket')
+# Session users allowed to read everyone's usage; everyone else only sees their own
+USAGE_ADMIN_EMAILS = {email.strip().lower() for email in os.getenv('USAGE_ADMIN_EMAILS', '').split(',') if email.strip()}
+
+TOTALS_ID = 'totals'
+
+def bucket_start(when, seconds=USAGE_BUCKET_SECONDS):
+    epoch = datetime(1970, 1, 1)
+    offset = int((when - epoch).total_seconds()) // seconds * seconds
+    return epoch + timedelta(seconds=offset)
+
+def parse_time(value):
+    """ISO date or datetime as naive UTC, the form buckets are stored in"""
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is not None:
+        when = when.astimezone(timezone.utc).replace(tzinfo=None)
+    return when
+
+def normalize_usage(usage):
+    """Token counts from llama.cpp/OpenAI (prompt/completion) or Anthropic (input/output) usage"""
+    usage = usage or {}
+    prompt = usage.get('prompt_tokens', usage.get('input_tokens', 0)) or 0
+    completion = usage.get('completion_tokens', usage.get('output_tokens', 0)) or 0
+    return prompt, completion
+
+class UsageAnalytics:
+    """Aggregate counters and per-request token usage rollups.
+
+    Totals for users, chats and models live in one counters document that is
+    incremented as they are created or deleted, so reading them is a single
+    lookup instead of three collection scans. Token usage is added into one
+    document per (bucket, user, provider, model). Writes go through `update`,
+    which the app points at the write-behind queue so bursts of $inc
+    operations are coalesced.
+    """
+
+    def __init__(self, database, update=None, bucket_seconds=USAGE_BUCKET_SECONDS):
+        self.counters = database['counters']
+        self.usage = database['usage']
+        self.bucket_seconds = bucket_seconds
+        self.update = update or (lambda collection, filter_doc, doc, upsert: collection.update_one(
+            filter_doc, doc, upsert=upsert))
+
+    def seed(self, database, force=False):
+        """Initialise the counters from exact counts; only scans when they do not exist yet"""
+        if not force and self.counters.find_one({'_id': TOTALS_ID}) is not None:
+            return False
+        totals = {name: database[name].count_documents({}) for name in ('users', 'chats', 'models')}
+        self.counters.update_one(
+            {'_id': TOTALS_ID},
+            {'$set': dict(totals, seeded_at=datetime.utcnow(), updated_at=datetime.utcnow())},
+            upsert=True
+        )
+        return True
+
+    def increment(self, **deltas):
+        deltas = {name: amount for name, amount in deltas.items() if amount}
+        if deltas:
+            self.update(self.counters, {'_id': TOTALS_ID},
+                        {'$inc': deltas, '$set': {'updated_at': datetime.utcnow()}}, True)
+
+    def totals(self):
+        doc = self.counters.find_one({'_id': TOTALS_ID}) or {}
+        return {
+            'total_users': doc.get('users', 0),
+            'total_chats': doc.get('chats', 0),
+            'total_models': doc.get('models', 0),
+            'updated_at': doc['updated_at'].isoformat() if isinstance(doc.get('updated_at'), datetime) else None
+        }
+
+    def record(self, user, provider, model, usage, when=None):
+        prompt, completion = normalize_usage(usage)
+        bucket = bucket_start(when or datetime.utcnow(), self.bucket_seconds)
+        key = f'{bucket.isoformat()}|{user}|{provider}|{model}'
+        self.update(self.usage, {'_id': key}, {
+            '$inc': {
+                'requests': 1,
+                'prompt_tokens': prompt,
+                'completion_tokens': completion,
+                'total_tokens': prompt + completion
+            },
+            '$setOnInsert': {'bucket': bucket, 'user': user, 'provider': provider, 'model': model}
+        }, True)
+
+    def query(self, start, end, user=None, group_by=None):
+        """Usage in [start, end), summed overall and optionally per user, model, provider or bucket"""
+        if group_by is not None and group_by not in USAGE_GROUPS:
+            raise ValueError(f"group_by must be one of {', '.join(USAGE_GROUPS)}")
+        filter_doc = {'bucket': {'$gte': bucket_start(start, self.bucket_seconds), '$lt': end}}
+        if user:
+            filter_doc['user'] = user
+        fields = ('requests', 'prompt_tokens', 'completion_tokens', 'total_tokens')
+        total = dict.fromkeys(fields, 0)
+        groups = {}
+        for doc in self.usage.find(filter_doc):
+            for field in fields:
+                total[field] += doc.get(field, 0)
+            if group_by:
+                value = doc.get(group_by)
+                if isinstance(value, datetime):
+                    value = value.isoformat()
+                group = groups.setdefault(value, dict.fromkeys(fields, 0))
+                for field in fields:
+                    group[field] += doc.get(field, 0)
+        result = {
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'bucket_seconds': self.bucket_seconds,
+            'usage': total
+        }
+        if group_by:
+            result['group_by'] = group_by
+            result['groups'] = [dict(group, **{group_by: value}) for value, group in sorted(
+                groups.items(), key=lambda item: str(item[0]))]
+        return result
@@ -1,28 +1,55 @@
-from flask import Flask, request, jsonify, Response, stream_with_context
+from flask import Flask, request, jsonify, Response, stream_with_context, send_file
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import json
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import requests
-import hashlib
-from pymongo import MongoClient
 from bson import ObjectId
 from dotenv import load_dotenv
 import re
 import gc
+import uuid
+import atexit
+import signal
+import random
+import select
+import socket
+import threading
+import importlib.util
 
-# Try to import llama_cpp but make it optional
-try:
-    from llama_cpp import Llama
-    LLAMA_AVAILABLE = True
-except ImportError:
+# Local modules read their settings from the environment at import time
+load_dotenv()
+
+import auth
+import quota
+import speculative
+import startup
+import downloader
+import batch
+import embeddings
+import grammar
+import lora
+import storage
+import writebehind
+import compression
+import chattree
+import analytics
+
+# llama_cpp is optional and imported on first model load to keep boot fast
+LLAMA_AVAILABLE = importlib.util.find_spec('llama_cpp') is not None
+if not LLAMA_AVAILABLE:
     print("Warning: llama-cpp-python not installed. GGUF models will not work.")
-    LLAMA_AVAILABLE = False
-    Llama = None
+Llama = None
 
-load_dotenv()
+def get_llama():
+    global Llama
+    if Llama is None:
+        from llama_cpp import Llama as llama_class
+        Llama = llama_class
+    return Llama
 
 app = Flask(__name__)
 # CORS to allow frontend connection
@@ -39,35 +66,210 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['MODEL_FOLDER'] = MODEL_FOLDER
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', '')
+if not auth.secret_key_configured(app.config['SECRET_KEY']):
+    print("⚠️  SECRET_KEY is unset or a placeholder: session tokens are disabled")
+
+# Run several backends behind router.py by giving each its own port
+PORT = int(os.getenv('PORT', 5001))
+# Proxies in front of this backend (1 behind router.py); their X-Forwarded-For
+# sets remote_addr, which keys quotas and batch ownership for anonymous callers
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', 0))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT,
+                            x_host=TRUSTED_PROXY_COUNT)
 
 MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
 DB_NAME = os.getenv('DB_NAME', 'chatbot_db')
 
-try:
-    mongo_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-    # Test the connection
-    mongo_client.server_info()
-    db = mongo_client[DB_NAME]
-    users_collection = db['users']
-    chats_collection = db['chats']
-    models_collection = db['models']
-    users_collection.create_index('email', unique=True)
-    chats_collection.create_index('user_email')
-    chats_collection.create_index('created_at')
-    print("✓ MongoDB connected successfully")
-except Exception as e:
-    print(f"✗ MongoDB connection failed: {e}")
-    print("Running without database - using local storage only")
-    db = None
+# The database connects in the background; routes see db = None until it is ready
+db = None
+users_collection = None
+chats_collection = None
+models_collection = None
+# Chat messages live in a tree of nodes; chats only keep a head pointer
+chat_tree = None
+# Maintained counters and token usage rollups behind /api/stats
+usage_stats = None
+db_status = 'connecting'
 
 current_model = None
 current_model_name = None
+# n_ctx / n_gpu_layers the main model was loaded with, to reload it when a draft model is added
+current_model_config = {}
+# Optional small model that proposes tokens for speculative decoding
+draft_model = None
+# Optional GGUF embedding model for /api/embeddings, independent of the chat model
+embedding_model = None
+embedding_model_name = None
+embedding_lock = threading.Lock()
+embedding_cache = embeddings.EmbeddingCache()
+# LoRA adapters applied per request on top of current_model
+lora_manager = lora.LoraManager()
+# Serializes model loads between API calls and background preloading
+model_lock = threading.Lock()
+# The single inference slot on the loaded model
+inference_lock = threading.Lock()
+
+quota_manager = None
+if quota.QUOTA_ENABLED:
+    quota_manager = quota.QuotaManager()
+
+def connect_database():
+    global db, users_collection, chats_collection, models_collection, chat_tree, usage_stats, db_status
+    try:
+        try:
+            database = storage.open_database(storage.STORAGE_BACKEND, MONGO_URI, DB_NAME)
+        except Exception as e:
+            if not storage.STORAGE_FALLBACK or storage.STORAGE_FALLBACK == storage.STORAGE_BACKEND:
+                raise
+            print(f"✗ {storage.STORAGE_BACKEND} storage unavailable ({e}), falling back to {storage.STORAGE_FALLBACK}")
+            database = storage.open_database(storage.STORAGE_FALLBACK, MONGO_URI, DB_NAME)
+        storage.ensure_indexes(database)
+        users_collection = database['users']
+        chats_collection = database['chats']
+        models_collection = database['models']
+        chat_tree = chattree.ChatTree(database['nodes'], message_codec,
+                                      compress=compression.MESSAGE_COMPRESSION_ENABLED,
+                                      update=queue_update, sync=lambda: sync_writes('nodes'))
+        if analytics.ANALYTICS_ENABLED:
+            usage_stats = analytics.UsageAnalytics(database, update=queue_update)
+            if usage_stats.seed(database):
+                print("✓ Seeded aggregate counters from the existing collections")
+        if quota_manager and quota.QUOTA_SHARED_STORE:
+            quota_manager.store = quota.MongoQuotaStore(database['quotas'])
+        db = database
+        db_status = 'connected'
+        print(f"✓ Database connected successfully ({type(database).__name__})")
+        # A model preloaded before the database was ready gets its adapters now
+        restore_lora_adapters()
+    except Exception as e:
+        print(f"✗ Database connection failed: {e}")
+        print("Running without database - using local storage only")
+        db_status = 'disconnected'
+
+write_behind = writebehind.WriteBehindQueue() if writebehind.WRITE_BEHIND_ENABLED else None
+atexit.register(lambda: write_behind and write_behind.close())
+
+def install_sigterm_flush():
+    """atexit does not run on SIGTERM (docker stop, systemd), so flush queued writes there too"""
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        if write_behind is not None:
+            write_behind.close()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            raise SystemExit(128 + signum)
+    try:
+        signal.signal(signal.SIGTERM, handle_sigterm)
+    except ValueError:
+        # Only the main thread may install handlers; the embedding server handles shutdown
+        pass
+
+install_sigterm_flush()
+
+def queue_update(collection, filter_doc, update, upsert=False):
+    """Update through the write-behind queue when enabled; returns a WriteAck, or None if written inline"""
+    if write_behind is None:
+        collection.update_one(filter_doc, update, upsert=upsert)
+        return None
+    return write_behind.update_one(collection, filter_doc, update, upsert=upsert)
+
+def sync_writes(collection_name):
+    """Make queued writes visible before reading a collection"""
+    if write_behind is not None:
+        write_behind.sync(collection_name)
+
+message_codec = compression.MessageCodec()
+
+def unpack_messages(messages):
+    # Chats saved before the message tree keep their compressed messages array
+    return message_codec.decompress_messages(messages)
+
+def chat_messages(chat, loaded):
+    """Active-branch messages of a chat, from the node tree or a legacy messages array"""
+    if chat.get('head'):
+        return loaded.get(chat['chat_id'], [])
+    return unpack_messages(chat.get('messages'))
+
+def compressed_jsonify(payload, status=200):
+    """jsonify, compressed with the best encoding the client accepts"""
+    response = jsonify(payload)
+    response.status_code = status
+    response.headers['Vary'] = 'Accept-Encoding'
+    body = response.get_data()
+    if len(body) < compression.RESPONSE_COMPRESSION_MIN_SIZE:
+        return response
+    encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding:
+        response.set_data(compression.compress_body(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
 
 def allowed_file(filename, extension):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() == extension
 
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    return auth.hash_password(password)
+
+@app.errorhandler(auth.AuthBusy)
+def auth_busy(e):
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = str(max(1, int(e.retry_after)))
+    return response, 503
+
+def get_session_user():
+    """Return the payload of the request's bearer token, or None"""
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    return auth.verify_token(app.config['SECRET_KEY'], header[len('Bearer '):].strip())
+
+def resolve_user_email(email):
+    """Prefer the email from a valid session token over the one the client sent"""
+    session_user = get_session_user()
+    if session_user:
+        return session_user['email']
+    return email
+
+def get_quota_user():
+    """Identify who a request is charged to: the verified session user, else the client address.
+
+    The user_email a client sends is never trusted here, or anyone could spend
+    someone else's budget or rotate emails to escape theirs.
+    """
+    session_user = get_session_user()
+    if session_user:
+        return session_user['email']
+    return request.remote_addr or 'anonymous'
+
+def get_generated_tokens(usage):
+    # llama.cpp/OpenAI report completion_tokens, Anthropic reports output_tokens
+    return usage.get('completion_tokens', usage.get('output_tokens', 0)) or 0
+
+def record_usage(user, quota_model, provider, model_name, usage):
+    """Charge a finished request to the quota and add it to the usage rollups"""
+    if quota_manager:
+        quota_manager.record_usage(user, quota_model, get_generated_tokens(usage))
+    if usage_stats is not None:
+        try:
+            usage_stats.record(user, provider, model_name, usage)
+        except Exception as e:
+            print(f"⚠️  Failed to record usage: {e}")
+
+def count_change(**deltas):
+    if usage_stats is not None:
+        usage_stats.increment(**deltas)
+
+def upsert_model(filename, fields):
+    """Upsert a model document, counting it in the totals the first time it is seen"""
+    sync_writes('models')
+    is_new = models_collection.find_one({'filename': filename}) is None
+    queue_update(models_collection, {'filename': filename}, {'$set': fields}, upsert=True)
+    if is_new:
+        count_change(models=1)
 
 def serialize_doc(doc):
     if doc is None:
@@ -186,8 +388,11 @@ def signup():
         'updated_at': datetime.utcnow()
     }
     result = users_collection.insert_one(user_doc)
+    user_doc['_id'] = result.inserted_id
+    count_change(users=1)
     return jsonify({
         'message': 'User created successfully',
+        'token': auth.issue_token(app.config['SECRET_KEY'], user_doc),
         'user': {
             'id': str(result.inserted_id),
             'username': username,
@@ -205,10 +410,17 @@ def login():
     if not email or not password:
         return jsonify({'error': 'Email and password required'}), 400
     user = users_collection.find_one({'email': email})
-    if not user or user['password'] != hash_password(password):
+    if not user or not auth.verify_password(email, password, user['password']):
         return jsonify({'error': 'Invalid credentials'}), 401
+    # Transparently upgrade legacy SHA-256 / outdated scrypt hashes
+    if auth.needs_rehash(user['password']):
+        users_collection.update_one(
+            {'_id': user['_id']},
+            {'$set': {'password': hash_password(password), 'updated_at': datetime.utcnow()}}
+        )
     return jsonify({
         'message': 'Login successful',
+        'token': auth.issue_token(app.config['SECRET_KEY'], user),
         'user': {
             'id': str(user['_id']),
             'username': user['username'],
@@ -217,11 +429,20 @@ def login():
         }
     }), 200
 
+@app.route('/api/auth/session', methods=['GET'])
+def session_info():
+    # Stateless: the signed token is enough, no database lookup
+    session_user = get_session_user()
+    if not session_user:
+        return jsonify({'error': 'Invalid or expired session token'}), 401
+    return jsonify({'user': session_user}), 200
+
 @app.route('/api/auth/profile', methods=['GET', 'PUT'])
 def profile():
     if db is None:
         return jsonify({'error': 'Database not available'}), 500
     email = request.args.get('email') if request.method == 'GET' else request.json.get('email')
+    email = resolve_user_email(email)
     if not email:
         return jsonify({'error': 'Email required'}), 400
     if request.method == 'GET':
@@ -302,11 +523,7 @@ def upload_model():
                         'size': file_size,
                         'uploaded_at': datetime.utcnow()
                     }
-                    models_collection.update_one(
-                        {'filename': safe_filename},
-                        {'$set': model_doc},
-                        upsert=True
-                    )
+                    upsert_model(safe_filename, model_doc)
                 
                 return jsonify({
                     'message': 'Model already exists',
@@ -344,11 +561,7 @@ def upload_model():
                 'size': file_size,
                 'uploaded_at': datetime.utcnow()
             }
-            models_collection.update_one(
-                {'filename': safe_filename},
-                {'$set': model_doc},
-                upsert=True
-            )
+            upsert_model(safe_filename, model_doc)
         
         return jsonify({
             'message': 'Model uploaded successfully',
@@ -369,20 +582,96 @@ def upload_model():
         print(f"Upload error: {error_msg}")
         return jsonify({'error': error_msg}), 500
 
+download_manager = downloader.DownloadManager()
+
+def register_downloaded_model(job):
+    if db is not None:
+        upsert_model(job.filename, {
+            'filename': job.filename,
+            'filepath': job.filepath,
+            'size': job.total_size,
+            'sha256': job.sha256,
+            'source_url': job.url,
+            'uploaded_at': datetime.utcnow()
+        })
+
+@app.route('/api/model/download', methods=['POST'])
+def download_model():
+    data = request.json or {}
+    url = data.get('url')
+    if not url or not url.startswith(('http://', 'https://')):
+        return jsonify({'error': 'A http(s) URL is required'}), 400
+    
+    filename = data.get('filename') or url.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+    if not allowed_file(filename, 'gguf'):
+        return jsonify({'error': 'Only .gguf files allowed'}), 400
+    safe_filename = get_windows_safe_path(filename)
+    model_folder = os.path.abspath(app.config['MODEL_FOLDER'])
+    filepath = os.path.normpath(os.path.join(model_folder, safe_filename))
+    if not filepath.startswith(model_folder):
+        return jsonify({'error': 'Invalid file path'}), 400
+    if os.path.exists(filepath):
+        return jsonify({'error': f'Model {safe_filename} already exists'}), 409
+    os.makedirs(model_folder, exist_ok=True)
+    
+    try:
+        connections = int(data.get('connections', downloader.DOWNLOAD_CONNECTIONS))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'connections must be an integer'}), 400
+    if not 1 <= connections <= downloader.DOWNLOAD_MAX_CONNECTIONS:
+        return jsonify({'error': f'connections must be between 1 and {downloader.DOWNLOAD_MAX_CONNECTIONS}'}), 400
+    
+    try:
+        job = download_manager.submit(
+            url, filepath,
+            auth_token=data.get('auth_token'),
+            expected_sha256=data.get('sha256'),
+            connections=connections,
+            on_complete=register_downloaded_model
+        )
+    except downloader.DownloadError as e:
+        return jsonify({'error': str(e)}), 409
+    
+    print(f"Started download job {job.id}: {url} -> {filepath}")
+    return jsonify({'message': 'Download started', 'job_id': job.id, 'filename': safe_filename}), 202
+
+@app.route('/api/model/download', methods=['GET'])
+def list_downloads():
+    return jsonify({'jobs': download_manager.list()}), 200
+
+@app.route('/api/model/download/<job_id>', methods=['GET', 'DELETE'])
+def download_status(job_id):
+    job = download_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Download job not found'}), 404
+    if request.method == 'DELETE':
+        job.cancel()
+        return jsonify({'message': 'Download cancelled', 'job_id': job_id}), 200
+    return jsonify(job.progress()), 200
+
 @app.route('/api/model/load', methods=['POST'])
 def load_model():
-    global current_model, current_model_name
-    
     if not LLAMA_AVAILABLE:
         return jsonify({'error': 'llama-cpp-python is not installed. Install it with: pip install llama-cpp-python'}), 500
     
     data = request.json
-    model_name = data.get('model_name')
-    n_ctx = data.get('n_ctx', 2048)
-    n_gpu_layers = data.get('n_gpu_layers', 0)
+    with model_lock, inference_lock:
+        result, status = load_model_file(
+            data.get('model_name'),
+            n_ctx=data.get('n_ctx', 2048),
+            n_gpu_layers=data.get('n_gpu_layers', 0),
+            role=data.get('role', 'main')
+        )
+    return jsonify(result), status
+
+def load_model_file(model_name, n_ctx=2048, n_gpu_layers=0, role='main'):
+    """Load a GGUF from the model folder; returns (response dict, HTTP status)"""
+    global current_model, current_model_name, current_model_config
     
     if not model_name:
-        return jsonify({'error': 'Model name required'}), 400
+        return {'error': 'Model name required'}, 400
+    if role not in ('main', 'draft', 'embedding'):
+        return {'error': "role must be 'main', 'draft' or 'embedding'"}, 400
     
     # Use the same path handling as upload for consistency
     safe_model_name = get_windows_safe_path(model_name)
@@ -399,7 +688,7 @@ def load_model():
     
     # Security check
     if not model_path.startswith(os.path.abspath(model_folder)):
-        return jsonify({'error': 'Invalid model path'}), 400
+        return {'error': 'Invalid model path'}, 400
     
     # Check if file exists
     if not os.path.exists(model_path):
@@ -408,26 +697,33 @@ def load_model():
         if available_models:
             error_msg += f'\n\nAvailable models:\n' + '\n'.join(f'  - {m}' for m in available_models)
         print(f"❌ {error_msg}")
-        return jsonify({'error': error_msg}), 404
+        return {'error': error_msg}, 404
     
     # Validate it's a file
     if not os.path.isfile(model_path):
-        return jsonify({'error': f'{model_path} is not a file'}), 400
+        return {'error': f'{model_path} is not a file'}, 400
     
     # Validate GGUF file
     is_valid, validation_msg = validate_gguf_file(model_path)
     print(f"File validation: {validation_msg}")
     
     if not is_valid:
-        return jsonify({
+        return {
             'error': f'Invalid GGUF file: {validation_msg}',
             'suggestion': 'The file may be corrupted. Try re-downloading or re-uploading the model.'
-        }), 400
+        }, 400
+    
+    if role == 'draft':
+        return load_draft_model(model_path, safe_model_name, n_ctx, n_gpu_layers, validation_msg)
+    if role == 'embedding':
+        return load_embedding_model(model_path, safe_model_name, n_ctx, n_gpu_layers, validation_msg)
     
     try:
         # Unload current model
         if current_model:
             print(f"Unloading previous model: {current_model_name}")
+            # Adapters belong to the base model and must be freed first
+            lora_manager.release_all(current_model)
             try:
                 del current_model
             except:
@@ -445,10 +741,12 @@ def load_model():
         
         # Try loading with user settings
         try:
-            current_model = Llama(
+            current_model = get_llama()(
                 model_path=model_path,
                 n_ctx=n_ctx,
                 n_gpu_layers=n_gpu_layers,
+                # Speculative verification reads the logits of every drafted position
+                logits_all=draft_model is not None,
                 verbose=True,
                 use_mlock=False,
                 use_mmap=True,
@@ -462,10 +760,11 @@ def load_model():
             print("Retrying with conservative settings (CPU only, reduced context)...")
             
             try:
-                current_model = Llama(
+                current_model = get_llama()(
                     model_path=model_path,
                     n_ctx=min(n_ctx, 512),  # Drastically reduce context
                     n_gpu_layers=0,  # No GPU
+                    logits_all=draft_model is not None,
                     verbose=True,
                     use_mlock=False,
                     use_mmap=True,
@@ -491,13 +790,18 @@ def load_model():
                 if not suggestions:
                     suggestions.append("Try updating llama-cpp-python or use a different model format")
                 
-                return jsonify({
+                return {
                     'error': f'Failed to load model: {error_detail}',
                     'suggestions': suggestions,
                     'model_path': model_path
-                }), 500
+                }, 500
         
         current_model_name = safe_model_name
+        current_model_config = {'n_ctx': n_ctx, 'n_gpu_layers': n_gpu_layers}
+        lora_manager.set_base_model(safe_model_name)
+        restore_lora_adapters()
+        detach_incompatible_draft()
+        startup.record_snapshot('main', safe_model_name, n_ctx, n_gpu_layers)
         
         # Test the model
         print("\nTesting model generation...")
@@ -512,21 +816,17 @@ def load_model():
         
         # Update database
         if db is not None:
-            models_collection.update_one(
-                {'filename': safe_model_name},
-                {'$set': {
-                    'last_loaded': datetime.utcnow(),
-                    'n_ctx': n_ctx,
-                    'n_gpu_layers': n_gpu_layers
-                }},
-                upsert=True
-            )
+            upsert_model(safe_model_name, {
+                'last_loaded': datetime.utcnow(),
+                'n_ctx': n_ctx,
+                'n_gpu_layers': n_gpu_layers
+            })
         
         print(f"\n{'='*60}")
         print("✓ MODEL LOADED SUCCESSFULLY")
         print(f"{'='*60}\n")
         
-        return jsonify({
+        return {
             'message': 'Model loaded successfully',
             'model_name': safe_model_name,
             'model_path': model_path,
@@ -534,7 +834,7 @@ def load_model():
             'n_gpu_layers': n_gpu_layers,
             'validation': validation_msg,
             'test_response': test_text
-        }), 200
+        }, 200
         
     except Exception as e:
         error_msg = str(e)
@@ -548,6 +848,7 @@ def load_model():
         
         # Clean up
         if current_model:
+            lora_manager.release_all(current_model)
             try:
                 del current_model
             except:
@@ -567,31 +868,193 @@ def load_model():
             suggestions.append("Check that llama-cpp-python is properly installed")
             suggestions.append("Try: pip install llama-cpp-python --force-reinstall")
         
-        return jsonify({
+        return {
             'error': f'Failed to load model: {error_msg}',
             'suggestions': suggestions,
             'model_path': model_path
-        }), 500
+        }, 500
+
+def detach_incompatible_draft():
+    """Speculative decoding only works when draft and main model share a vocabulary"""
+    global draft_model
+    if draft_model and current_model and draft_model.llama.n_vocab() != current_model.n_vocab():
+        print(f"⚠️  Draft model {draft_model.model_name} vocabulary does not match {current_model_name}, unloading it")
+        draft_model = None
+        gc.collect()
+
+def load_draft_model(model_path, model_name, n_ctx, n_gpu_layers, validation_msg):
+    global draft_model
+    if draft_model:
+        print(f"Unloading previous draft model: {draft_model.model_name}")
+        draft_model = None
+        gc.collect()
+    
+    print(f"Loading draft model for speculative decoding: {model_name}")
+    try:
+        draft_llama = get_llama()(
+            model_path=model_path,
+            n_ctx=n_ctx,
+            n_gpu_layers=n_gpu_layers,
+            verbose=False,
+            use_mlock=False,
+            use_mmap=True,
+            n_threads=4
+        )
+    except Exception as e:
+        print(f"❌ Failed to load draft model: {e}")
+        return {'error': f'Failed to load draft model: {str(e)}', 'model_path': model_path}, 500
+    
+    if current_model and draft_llama.n_vocab() != current_model.n_vocab():
+        del draft_llama
+        gc.collect()
+        return {'error': f'Draft model vocabulary does not match {current_model_name}'}, 400
+    
+    draft_model = speculative.GGUFDraftModel(draft_llama, model_name)
+    print(f"✓ Draft model loaded: {model_name}")
+    startup.record_snapshot('draft', model_name, n_ctx, n_gpu_layers)
+    
+    # A main model built without logits_all only keeps the last logits row per
+    # eval, so verifying drafted tokens would read stale rows; rebuild it
+    main_reloaded = False
+    if current_model is not None and not getattr(current_model, '_logits_all', False):
+        print(f"Reloading {current_model_name} with logits_all for speculative decoding")
+        result, status = load_model_file(current_model_name, role='main', **current_model_config)
+        if status != 200:
+            draft_model = None
+            gc.collect()
+            return {'error': f"Failed to reload main model for speculative decoding: {result.get('error')}"}, status
+        main_reloaded = True
+    
+    if db is not None:
+        upsert_model(model_name, {
+            'last_loaded': datetime.utcnow(),
+            'n_ctx': n_ctx,
+            'n_gpu_layers': n_gpu_layers,
+            'role': 'draft'
+        })
+    
+    return {
+        'message': 'Draft model loaded successfully',
+        'model_name': model_name,
+        'model_path': model_path,
+        'role': 'draft',
+        'n_ctx': n_ctx,
+        'n_gpu_layers': n_gpu_layers,
+        'draft_tokens': draft_model.num_pred_tokens,
+        'main_model_reloaded': main_reloaded,
+        'validation': validation_msg
+    }, 200
+
+def load_embedding_model(model_path, model_name, n_ctx, n_gpu_layers, validation_msg):
+    global embedding_model, embedding_model_name
+    with embedding_lock:
+        if embedding_model:
+            print(f"Unloading previous embedding model: {embedding_model_name}")
+            embedding_model = None
+            embedding_model_name = None
+            gc.collect()
+        
+        print(f"Loading embedding model: {model_name}")
+        try:
+            embedding_model = get_llama()(
+                model_path=model_path,
+                n_ctx=n_ctx,
+                n_gpu_layers=n_gpu_layers,
+                embedding=True,
+                # Non-causal embedding models must see each input in a single
+                # ubatch; llama.cpp caps n_batch at n_ctx but keeps n_ubatch at 512
+                n_batch=n_ctx,
+                n_ubatch=n_ctx,
+                verbose=False,
+                use_mlock=False,
+                use_mmap=True,
+                n_threads=4
+            )
+        except Exception as e:
+            print(f"❌ Failed to load embedding model: {e}")
+            return {'error': f'Failed to load embedding model: {str(e)}', 'model_path': model_path}, 500
+        embedding_model_name = model_name
+    
+    print(f"✓ Embedding model loaded: {model_name} ({embedding_model.n_embd()} dimensions)")
+    startup.record_snapshot('embedding', model_name, n_ctx, n_gpu_layers)
+    
+    if db is not None:
+        upsert_model(model_name, {
+            'last_loaded': datetime.utcnow(),
+            'n_ctx': n_ctx,
+            'n_gpu_layers': n_gpu_layers,
+            'role': 'embedding'
+        })
+    
+    return {
+        'message': 'Embedding model loaded successfully',
+        'model_name': model_name,
+        'model_path': model_path,
+        'role': 'embedding',
+        'n_ctx': n_ctx,
+        'n_gpu_layers': n_gpu_layers,
+        'dimensions': embedding_model.n_embd(),
+        'validation': validation_msg
+    }, 200
 
 @app.route('/api/model/unload', methods=['POST'])
 def unload_model():
-    global current_model, current_model_name
-    if current_model:
-        try:
-            del current_model
-        except:
-            pass
-        current_model = None
-        current_model_name = None
-        gc.collect()
-        return jsonify({'message': 'Model unloaded successfully'}), 200
-    return jsonify({'message': 'No model loaded'}), 200
+    global current_model, current_model_name, current_model_config, draft_model, embedding_model, embedding_model_name
+    role = (request.get_json(silent=True) or {}).get('role')
+    if role == 'embedding':
+        with embedding_lock:
+            if embedding_model:
+                embedding_model = None
+                embedding_model_name = None
+                gc.collect()
+                startup.record_snapshot('embedding', None)
+                return jsonify({'message': 'Embedding model unloaded successfully'}), 200
+        return jsonify({'message': 'No embedding model loaded'}), 200
+    # Wait for any running generation before freeing the model
+    with model_lock, inference_lock:
+        if role == 'draft':
+            if draft_model:
+                draft_model = None
+                gc.collect()
+                startup.record_snapshot('draft', None)
+                # Without a draft the n_ctx x n_vocab logits buffer only slows evaluation down
+                main_reloaded = False
+                if current_model is not None and getattr(current_model, '_logits_all', False):
+                    print(f"Reloading {current_model_name} without logits_all")
+                    result, status = load_model_file(current_model_name, role='main', **current_model_config)
+                    if status != 200:
+                        return jsonify({
+                            'message': 'Draft model unloaded, but reloading the main model failed',
+                            'error': result.get('error')
+                        }), status
+                    main_reloaded = True
+                return jsonify({
+                    'message': 'Draft model unloaded successfully',
+                    'main_model_reloaded': main_reloaded
+                }), 200
+            return jsonify({'message': 'No draft model loaded'}), 200
+        if current_model:
+            lora_manager.release_all(current_model)
+            try:
+                del current_model
+            except:
+                pass
+            current_model = None
+            current_model_name = None
+            current_model_config = {}
+            lora_manager.set_base_model(None)
+            gc.collect()
+            startup.record_snapshot('main', None)
+            return jsonify({'message': 'Model unloaded successfully'}), 200
+        return jsonify({'message': 'No model loaded'}), 200
 
 @app.route('/api/model/status', methods=['GET'])
 def model_status():
     return jsonify({
         'loaded': current_model is not None,
         'model_name': current_model_name,
+        'draft_model_name': draft_model.model_name if draft_model else None,
+        'embedding_model_name': embedding_model_name,
         'llama_available': LLAMA_AVAILABLE
     }), 200
 
@@ -602,6 +1065,7 @@ def list_models():
     
     # Ensure folder exists
     os.makedirs(model_folder, exist_ok=True)
+    sync_writes('models')
     
     for filename in os.listdir(model_folder):
         if filename.endswith('.gguf'):
@@ -619,6 +1083,7 @@ def list_models():
                 'size': os.path.getsize(filepath),
                 'path': filepath,
                 'is_loaded': filename == current_model_name,
+                'is_draft': draft_model is not None and filename == draft_model.model_name,
                 'valid': is_valid,
                 'validation_message': validation_msg
             }
@@ -664,8 +1129,286 @@ def validate_model():
         'file_path': model_path
     }), 200
 
+# ==================== LORA ROUTES ====================
+
+def restore_lora_adapters():
+    """Re-register the stored adapters that were registered for the loaded base model"""
+    if db is None or not current_model_name:
+        return
+    for doc in models_collection.find({'role': 'lora', 'base_model': current_model_name}):
+        name = doc.get('adapter_name')
+        if not name or name in lora_manager.registered:
+            continue
+        if not os.path.isfile(doc.get('filepath') or ''):
+            print(f"⚠️  LoRA adapter {name} file is missing: {doc.get('filepath')}")
+            continue
+        lora_manager.register(name, doc['filepath'], doc.get('scale', 1.0), base_model=current_model_name)
+        print(f"✓ Restored LoRA adapter {name} for {current_model_name}")
+
+@app.route('/api/lora', methods=['GET'])
+def list_lora_adapters():
+    status = lora_manager.status()
+    status['base_model'] = current_model_name
+    return jsonify(status), 200
+
+@app.route('/api/lora/register', methods=['POST'])
+def register_lora_adapter():
+    data = request.json or {}
+    name = data.get('name')
+    filename = data.get('filename')
+    if not name or not filename:
+        return jsonify({'error': 'Adapter name and filename required'}), 400
+    
+    safe_filename = get_windows_safe_path(filename)
+    model_folder = os.path.abspath(app.config['MODEL_FOLDER'])
+    adapter_path = os.path.normpath(os.path.join(model_folder, safe_filename))
+    if not adapter_path.startswith(model_folder):
+        return jsonify({'error': 'Invalid adapter path'}), 400
+    if not os.path.isfile(adapter_path):
+        return jsonify({'error': f'Adapter file not found: {safe_filename}'}), 404
+    is_valid, validation_msg = validate_gguf_file(adapter_path)
+    if not is_valid:
+        return jsonify({'error': f'Invalid GGUF file: {validation_msg}'}), 400
+    try:
+        scale = float(data.get('scale', 1.0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'scale must be a number'}), 400
+    
+    # Adapters are trained against one base model and only registered for it
+    with model_lock:
+        if not current_model_name:
+            return jsonify({'error': 'Load the base model before registering adapters for it'}), 400
+        lora_manager.register(name, adapter_path, scale, base_model=current_model_name)
+    if db is not None:
+        upsert_model(safe_filename, {
+            'filename': safe_filename,
+            'filepath': adapter_path,
+            'size': os.path.getsize(adapter_path),
+            'role': 'lora',
+            'adapter_name': name,
+            'scale': scale,
+            'base_model': current_model_name
+        })
+    return jsonify({
+        'message': 'Adapter registered',
+        'name': name,
+        'filename': safe_filename,
+        'base_model': current_model_name,
+        'validation': validation_msg
+    }), 200
+
+@app.route('/api/lora/<name>', methods=['DELETE'])
+def unregister_lora_adapter(name):
+    with inference_lock:
+        info = lora_manager.registered.get(name)
+        removed = lora_manager.unregister(current_model, name)
+    if not removed:
+        return jsonify({'error': 'Adapter not found'}), 404
+    if db is not None:
+        # Keep the file's row but stop restoring it at startup
+        sync_writes('models')
+        models_collection.update_one(
+            {'filename': os.path.basename(info['path'])},
+            {'$unset': {'adapter_name': '', 'base_model': ''}}
+        )
+    return jsonify({'message': 'Adapter removed', 'name': name}), 200
+
 # ==================== CHAT ROUTES ====================
 
+def set_model_threads(model, n_threads):
+    try:
+        import llama_cpp
+        llama_cpp.llama_set_n_threads(model.ctx, n_threads, n_threads)
+    except Exception as e:
+        print(f"⚠️  Could not set thread count: {e}")
+
+class GenerationCancelled(Exception):
+    pass
+
+# request_id -> threading.Event for generations that can still be cancelled
+active_generations = {}
+active_generations_lock = threading.Lock()
+
+def register_generation(request_id):
+    event = threading.Event()
+    with active_generations_lock:
+        active_generations[request_id] = event
+    return event
+
+def unregister_generation(request_id):
+    with active_generations_lock:
+        active_generations.pop(request_id, None)
+
+def client_disconnected(environ):
+    """Peek at the client socket: readable with no data means the peer closed it"""
+    sock = environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+MAX_COMPLETION_CHOICES = int(os.getenv('MAX_COMPLETION_CHOICES', 8))
+grammar_cache = grammar.GrammarCache()
+
+def get_output_grammar(settings):
+    """Compiled grammar for a JSON response_format/json_schema setting, or None"""
+    constraint = grammar.get_constraint(settings)
+    if constraint is None:
+        return None
+    return grammar_cache.get_or_compile(*constraint)
+
+def get_sampling_settings(settings):
+    """Sampling parameters shared by every choice of a request"""
+    sampling = {
+        'temperature': settings.get('temperature', 0.7),
+        'top_p': settings.get('top_p', 0.9)
+    }
+    # Anything not sent keeps llama.cpp's own default
+    if settings.get('repetition_penalty') is not None:
+        sampling['repeat_penalty'] = settings['repetition_penalty']
+    for key in ('min_p', 'top_k', 'repeat_penalty', 'frequency_penalty', 'presence_penalty'):
+        if settings.get(key) is not None:
+            sampling[key] = settings[key]
+    return sampling
+
+def iter_gguf_completion(messages, settings, n_threads=None, cancel_event=None, is_disconnected=None,
+                         usage_out=None):
+    """Stream one or more completions from the loaded GGUF model.
+
+    Yields ('token', {'index', 'text'}) per streamed text chunk and finally
+    ('done', result). With settings['n'] > 1 the choices are sampled one after
+    another from the same prompt: llama.cpp keeps the evaluated prompt in its
+    KV cache and each later choice only truncates back to it, so the prompt is
+    evaluated once. Choice i uses seed + i, making regenerations reproducible.
+
+    Decoding stops at the next token boundary once cancel_event is set or
+    is_disconnected() reports the client went away; the result then carries
+    the partial text and usage with finish_reason 'cancelled'. usage_out, if
+    given, is kept up to date with the token counts even when the caller closes
+    the generator early.
+    """
+    prompt = format_messages_for_llama(messages)
+    max_tokens = settings.get('max_tokens', 512)
+    sampling = get_sampling_settings(settings)
+    n = max(1, min(int(settings.get('n', 1)), MAX_COMPLETION_CHOICES))
+    seed = settings.get('seed')
+    seed = int(seed) if seed is not None else random.randrange(2 ** 31)
+    stop = ["<|end|>", "<|user|>", "<|assistant|>", "\nUser:", "\nHuman:"]
+    output_grammar = get_output_grammar(settings)
+    if output_grammar is not None:
+        sampling['grammar'] = output_grammar
+        # Plain-text stops like "\nUser:" may legitimately appear inside a JSON string
+        stop = ["<|end|>", "<|user|>", "<|assistant|>"]
+    
+    # llama.cpp contexts are not thread-safe: one generation at a time
+    with inference_lock:
+        model = current_model
+        if model is None:
+            raise RuntimeError('No model loaded')
+        if cancel_event is not None and cancel_event.is_set():
+            raise GenerationCancelled('Cancelled before generation started')
+        lora_manager.activate(model, settings.get('adapter'))
+        
+        # Speculative decoding is on by default whenever a draft model is loaded
+        # Never on a context without per-position logits (see load_draft_model)
+        use_draft = (draft_model is not None and getattr(model, '_logits_all', False)
+                     and settings.get('speculative', True))
+        if use_draft:
+            draft_model.num_pred_tokens = speculative.clamp_draft_tokens(
+                settings.get('draft_tokens', speculative.SPECULATIVE_DRAFT_TOKENS))
+            draft_model.reset_stats()
+        model.draft_model = draft_model if use_draft else None
+        
+        if n_threads:
+            set_model_threads(model, n_threads)
+        choices = []
+        prompt_tokens = len(model.tokenize(prompt.encode('utf-8'), special=True))
+        completion_tokens = 0
+        if usage_out is not None:
+            usage_out.update(prompt_tokens=prompt_tokens, completion_tokens=0)
+        cancelled = False
+        try:
+            for index in range(n):
+                if cancelled:
+                    break
+                pieces = []
+                finish_reason = None
+                stream = model(
+                    prompt,
+                    max_tokens=max_tokens,
+                    seed=seed + index,
+                    echo=False,
+                    stream=True,
+                    stop=stop,
+                    **sampling
+                )
+                chunks = 0
+                try:
+                    for chunk in stream:
+                        choice = chunk['choices'][0]
+                        chunks += 1
+                        finish_reason = choice.get('finish_reason') or finish_reason
+                        if choice['text']:
+                            pieces.append(choice['text'])
+                            yield 'token', {'index': index, 'text': choice['text']}
+                        if cancel_event is not None and cancel_event.is_set():
+                            cancelled = True
+                        # Socket peeks are cheap but not free; check every few tokens
+                        elif is_disconnected is not None and chunks % 4 == 0 and is_disconnected():
+                            cancelled = True
+                        if cancelled:
+                            finish_reason = 'cancelled'
+                            break
+                finally:
+                    stream.close()
+                    # Chunks are not tokens: text is held back while a stop string may
+                    # still match and the last chunk is empty. The context knows exactly.
+                    completion_tokens += max(0, model.n_tokens - prompt_tokens)
+                    if usage_out is not None:
+                        usage_out['completion_tokens'] = completion_tokens
+                if use_draft:
+                    draft_model.finish(model.input_ids[:model.n_tokens])
+                text = ''.join(pieces)
+                choices.append({
+                    'index': index,
+                    # Grammar-constrained output is already exact; cleaning could cut valid JSON
+                    'response': text.strip() if output_grammar is not None else clean_llama_response(text),
+                    'finish_reason': finish_reason or 'stop',
+                    'seed': seed + index
+                })
+        finally:
+            if n_threads:
+                set_model_threads(model, model.context_params.n_threads)
+        
+        speculative_stats = draft_model.stats() if use_draft else None
+    
+    result = {
+        'response': choices[0]['response'],
+        'model': current_model_name,
+        'adapter': settings.get('adapter'),
+        'finish_reason': choices[0]['finish_reason'],
+        'seed': seed,
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+    }
+    if n > 1:
+        result['choices'] = choices
+    if speculative_stats:
+        result['speculative'] = speculative_stats
+    yield 'done', result
+
+def generate_gguf_completion(messages, settings, **kwargs):
+    """Run one completion on the loaded GGUF model; raises on failure"""
+    for kind, value in iter_gguf_completion(messages, settings, **kwargs):
+        if kind == 'done':
+            return value
+
 @app.route('/api/chat/completions', methods=['POST'])
 def chat_completion():
     global current_model
@@ -678,44 +1421,79 @@ def chat_completion():
     if not messages:
         return jsonify({'error': 'Messages required'}), 400
     
+    # Validate everything before charging the quota, so rejected requests cost nothing
     if model_type == 'gguf':
         if not current_model:
             return jsonify({'error': 'No model loaded. Please upload and load a GGUF model first.'}), 400
         
+        # OpenAI clients send response_format at the top level
+        for key in ('response_format', 'json_schema', 'adapter'):
+            if key in data:
+                settings = dict(settings, **{key: data[key]})
         try:
-            prompt = format_messages_for_llama(messages)
-            temperature = settings.get('temperature', 0.7)
-            max_tokens = settings.get('max_tokens', 512)
-            top_p = settings.get('top_p', 0.9)
-            
-            response = current_model(
-                prompt,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                echo=False,
-                stop=["<|end|>", "<|user|>", "<|assistant|>", "\nUser:", "\nHuman:"]
+            get_output_grammar(settings)
+        except grammar.GrammarError as e:
+            return jsonify({'error': str(e)}), 400
+        if settings.get('adapter') and settings['adapter'] not in lora_manager.registered:
+            return jsonify({'error': f"Unknown LoRA adapter: {settings['adapter']}"}), 400
+        for key in ('n', 'seed'):
+            if settings.get(key) is not None:
+                try:
+                    settings = dict(settings, **{key: int(settings[key])})
+                except (TypeError, ValueError):
+                    return jsonify({'error': f'{key} must be an integer'}), 400
+        quota_model = current_model_name
+    elif model_type in ('openai', 'claude'):
+        if not api_key:
+            return jsonify({'error': f"{'OpenAI' if model_type == 'openai' else 'Claude'} API key required"}), 400
+        quota_model = f"{model_type}:{settings.get('model', 'default')}"
+    else:
+        return jsonify({'error': 'Invalid model type'}), 400
+    try:
+        max_tokens = int(settings.get('max_tokens', 512))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'max_tokens must be an integer'}), 400
+    if max_tokens < 1:
+        return jsonify({'error': 'max_tokens must be at least 1'}), 400
+    settings = dict(settings, max_tokens=max_tokens)
+    
+    quota_user = get_quota_user()
+    if quota_manager:
+        # Reject before the request can occupy the model
+        try:
+            quota_manager.acquire(quota_user, quota_model)
+        except quota.QuotaExceeded as e:
+            response = jsonify({'error': e.reason, 'retry_after': round(e.retry_after, 1)})
+            response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+            return response, 429
+        settings['max_tokens'] = quota_manager.clamp_max_tokens(max_tokens)
+    
+    if model_type == 'gguf':
+        request_id = str(data.get('request_id') or uuid.uuid4().hex)
+        cancel_event = register_generation(request_id)
+        
+        if data.get('stream'):
+            return stream_gguf_completion(messages, settings, request_id, cancel_event, quota_user, quota_model)
+        
+        environ = request.environ
+        try:
+            result = generate_gguf_completion(
+                messages, settings,
+                cancel_event=cancel_event,
+                is_disconnected=lambda: client_disconnected(environ)
             )
+            record_usage(quota_user, quota_model, 'gguf', current_model_name, result['usage'])
+            result['request_id'] = request_id
+            return jsonify(result), 200
             
-            raw_response = response['choices'][0]['text']
-            cleaned_response = clean_llama_response(raw_response)
-            
-            return jsonify({
-                'response': cleaned_response,
-                'model': current_model_name,
-                'usage': {
-                    'prompt_tokens': response.get('usage', {}).get('prompt_tokens', 0),
-                    'completion_tokens': response.get('usage', {}).get('completion_tokens', 0),
-                    'total_tokens': response.get('usage', {}).get('total_tokens', 0)
-                }
-            }), 200
-            
+        except GenerationCancelled:
+            return jsonify({'error': 'Generation cancelled', 'request_id': request_id}), 499
         except Exception as e:
             return jsonify({'error': f'Model generation failed: {str(e)}'}), 500
+        finally:
+            unregister_generation(request_id)
     
     elif model_type == 'openai':
-        if not api_key:
-            return jsonify({'error': 'OpenAI API key required'}), 400
         try:
             response = requests.post(
                 'https://api.openai.com/v1/chat/completions',
@@ -734,6 +1512,7 @@ def chat_completion():
             if response.status_code != 200:
                 return jsonify({'error': response.json()}), response.status_code
             data = response.json()
+            record_usage(quota_user, quota_model, 'openai', data['model'], data.get('usage', {}))
             return jsonify({
                 'response': data['choices'][0]['message']['content'],
                 'model': data['model'],
@@ -743,8 +1522,6 @@ def chat_completion():
             return jsonify({'error': f'OpenAI API failed: {str(e)}'}), 500
     
     elif model_type == 'claude':
-        if not api_key:
-            return jsonify({'error': 'Claude API key required'}), 400
         try:
             response = requests.post(
                 'https://api.anthropic.com/v1/messages',
@@ -763,6 +1540,7 @@ def chat_completion():
             if response.status_code != 200:
                 return jsonify({'error': response.json()}), response.status_code
             data = response.json()
+            record_usage(quota_user, quota_model, 'claude', data['model'], data.get('usage', {}))
             return jsonify({
                 'response': data['content'][0]['text'],
                 'model': data['model'],
@@ -773,6 +1551,196 @@ def chat_completion():
     
     return jsonify({'error': 'Invalid model type'}), 400
 
+def stream_gguf_completion(messages, settings, request_id, cancel_event, quota_user, quota_model):
+    """Server-sent events: one event per token, then a final event with the cleaned text and usage"""
+    def events():
+        usage = {}
+        recorded = False
+        completion = iter_gguf_completion(messages, settings, cancel_event=cancel_event, usage_out=usage)
+        try:
+            for kind, value in completion:
+                if kind == 'token':
+                    yield f"data: {json.dumps({'request_id': request_id, 'index': value['index'], 'delta': value['text']})}\n\n"
+                else:
+                    record_usage(quota_user, quota_model, 'gguf', value['model'], value['usage'])
+                    recorded = True
+                    value['request_id'] = request_id
+                    yield f"data: {json.dumps(value)}\n\n"
+        except GenerationCancelled:
+            yield f"data: {json.dumps({'request_id': request_id, 'error': 'Generation cancelled'})}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'request_id': request_id, 'error': f'Model generation failed: {str(e)}'})}\n\n"
+        finally:
+            # Client went away mid-stream: closing the generator stops decoding and
+            # settles the token count, then charge what was produced
+            completion.close()
+            if not recorded:
+                record_usage(quota_user, quota_model, 'gguf', quota_model, usage)
+            unregister_generation(request_id)
+    
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Request-ID'] = request_id
+    return response
+
+@app.route('/api/chat/cancel', methods=['POST'])
+def cancel_chat():
+    request_id = (request.json or {}).get('request_id')
+    if not request_id:
+        return jsonify({'error': 'Request ID required'}), 400
+    with active_generations_lock:
+        event = active_generations.get(str(request_id))
+    if event is None:
+        return jsonify({'error': 'No active generation with that request ID'}), 404
+    event.set()
+    return jsonify({'message': 'Cancellation requested', 'request_id': request_id}), 200
+
+@app.route('/api/chat/quota', methods=['GET'])
+def quota_status():
+    if not quota_manager:
+        return jsonify({'enabled': False}), 200
+    model = request.args.get('model') or current_model_name
+    status = quota_manager.status(get_quota_user(), model)
+    status['enabled'] = True
+    return jsonify(status), 200
+
+# ==================== EMBEDDING ROUTES ====================
+
+@app.route('/api/embeddings', methods=['POST'])
+def create_embeddings():
+    if not embedding_model:
+        return jsonify({'error': 'No embedding model loaded. Load one with role "embedding" first.'}), 400
+    data = request.json or {}
+    inputs = data.get('input')
+    encoding_format = data.get('encoding_format', 'base64')
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if not inputs or not isinstance(inputs, list) or not all(isinstance(text, str) for text in inputs):
+        return jsonify({'error': 'input must be a string or a list of strings'}), 400
+    if len(inputs) > embeddings.EMBEDDING_MAX_INPUTS:
+        return jsonify({'error': f'At most {embeddings.EMBEDDING_MAX_INPUTS} inputs per request'}), 400
+    if encoding_format not in ('base64', 'binary', 'float'):
+        return jsonify({'error': "encoding_format must be 'base64', 'binary' or 'float'"}), 400
+    
+    model, model_name = embedding_model, embedding_model_name
+    try:
+        vectors, cached = embeddings.embed_texts(model, model_name, inputs, embedding_cache, embedding_lock)
+    except Exception as e:
+        return jsonify({'error': f'Embedding failed: {str(e)}'}), 500
+    dimensions = len(vectors[0]) // 4
+    
+    if encoding_format == 'binary':
+        # Row-major little-endian float32 matrix, shape in the headers
+        response = Response(b''.join(vectors), mimetype='application/octet-stream')
+        response.headers['X-Embedding-Count'] = str(len(vectors))
+        response.headers['X-Embedding-Dimensions'] = str(dimensions)
+        response.headers['X-Embedding-Model'] = model_name
+        response.headers['X-Embedding-Cached'] = str(cached)
+        return response
+    
+    return jsonify({
+        'object': 'list',
+        'model': model_name,
+        'dimensions': dimensions,
+        'encoding_format': encoding_format,
+        'data': [
+            {'object': 'embedding', 'index': i, 'embedding': vector}
+            for i, vector in enumerate(embeddings.encode_vectors(vectors, encoding_format))
+        ],
+        'usage': {'inputs': len(inputs), 'cached': cached}
+    }), 200
+
+@app.route('/api/embeddings/cache', methods=['GET', 'DELETE'])
+def embeddings_cache():
+    if request.method == 'DELETE':
+        embedding_cache.clear()
+        return jsonify({'message': 'Embedding cache cleared'}), 200
+    return jsonify(embedding_cache.stats()), 200
+
+# ==================== BATCH ROUTES ====================
+
+BATCH_THREADS = int(os.getenv('BATCH_THREADS', os.cpu_count() or 4))
+
+def run_batch_item(messages, settings, owner):
+    if not current_model:
+        raise RuntimeError('No model loaded')
+    model_name = current_model_name
+    if quota_manager:
+        # The job took one request slot; each item still has to fit the token budget
+        try:
+            quota_manager.check_tokens(owner or 'anonymous', model_name)
+        except quota.QuotaExceeded as e:
+            raise batch.BatchThrottled(e.reason, e.retry_after)
+        settings = dict(settings, max_tokens=quota_manager.clamp_max_tokens(settings.get('max_tokens', 512)))
+    # Offline work has no one waiting on it, so give it every core
+    result = generate_gguf_completion(messages, settings, n_threads=BATCH_THREADS)
+    record_usage(owner or 'anonymous', model_name, 'gguf', model_name, result['usage'])
+    return result
+
+def get_owned_batch(job_id):
+    """The batch job if the caller submitted it; others get the same 404 as a missing job"""
+    job = batch_runner.get(job_id)
+    if job is None or job.meta.get('owner') != get_quota_user():
+        return None
+    return job
+
+batch_runner = batch.BatchRunner(
+    run_batch_item,
+    prompt_key=lambda item: format_messages_for_llama(item['messages'])
+)
+
+@app.route('/api/batch', methods=['POST'])
+def submit_batch():
+    if not current_model:
+        return jsonify({'error': 'No model loaded. Please upload and load a GGUF model first.'}), 400
+    if 'file' in request.files:
+        content = request.files['file'].read().decode('utf-8')
+    else:
+        content = request.get_data(as_text=True)
+    # Jobs belong to the verified caller (session user, else client address), like quotas
+    owner = get_quota_user()
+    try:
+        batch.parse_batch_lines(content.splitlines())
+    except batch.BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    if quota_manager:
+        try:
+            quota_manager.acquire(owner, current_model_name)
+        except quota.QuotaExceeded as e:
+            response = jsonify({'error': e.reason, 'retry_after': round(e.retry_after, 1)})
+            response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+            return response, 429
+    try:
+        job = batch_runner.submit(content.splitlines(), owner=owner)
+    except batch.BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'message': 'Batch job queued', **job.status()}), 202
+
+@app.route('/api/batch/<job_id>', methods=['GET', 'DELETE'])
+def batch_status(job_id):
+    job = get_owned_batch(job_id)
+    if not job:
+        return jsonify({'error': 'Batch job not found'}), 404
+    if request.method == 'DELETE':
+        batch_runner.cancel(job_id)
+        return jsonify({'message': 'Batch job cancelled', 'job_id': job_id}), 200
+    return jsonify(job.status()), 200
+
+@app.route('/api/batch/<job_id>/output', methods=['GET'])
+def batch_output(job_id):
+    # Safe to fetch mid-run: results are appended one complete line at a time
+    job = get_owned_batch(job_id)
+    if not job:
+        return jsonify({'error': 'Batch job not found'}), 404
+    if not os.path.exists(job.output_path):
+        return Response('', mimetype='application/jsonl')
+    return send_file(job.output_path, mimetype='application/jsonl', as_attachment=True,
+                     download_name=f'batch_{job_id}.jsonl', max_age=0)
+
+@app.route('/api/chat/grammar-cache', methods=['GET'])
+def grammar_cache_stats():
+    return jsonify(grammar_cache.stats()), 200
+
 # ==================== FILE ROUTES ====================
 
 @app.route('/api/file/upload', methods=['POST'])
@@ -831,78 +1799,153 @@ def save_history():
     if db is None:
         return jsonify({'error': 'Database not available'}), 500
     data = request.json
-    user_email = data.get('user_email')
+    user_email = resolve_user_email(data.get('user_email'))
     chat_id = data.get('chat_id')
     messages = data.get('messages', [])
-    title = data.get('title', 'New Chat')
+    # With parent_id, `messages` only holds the messages to append under that node
+    parent_id = data.get('parent_id')
     if not user_email:
         return jsonify({'error': 'User email required'}), 400
     if not chat_id:
         chat_id = str(int(time.time() * 1000))
+    try:
+        head, new_nodes, node_acks = chat_tree.save_path(chat_id, user_email, messages, parent_id)
+    except chattree.ChatTreeError as e:
+        return jsonify({'error': str(e)}), 400
+    if not parent_id and new_nodes == len(messages):
+        # Nothing of this chat was stored yet: a new chat, unless it predates the message tree
+        sync_writes('chats')
+        if chats_collection.find_one({'chat_id': chat_id, 'user_email': user_email}) is None:
+            count_change(chats=1)
     chat_doc = {
         'chat_id': chat_id,
         'user_email': user_email,
-        'title': title,
-        'messages': messages,
+        'head': head,
         'created_at': datetime.utcnow(),
         'updated_at': datetime.utcnow()
     }
-    chats_collection.update_one(
+    update = {'$set': chat_doc, '$unset': {'messages': ''}}
+    if data.get('title'):
+        chat_doc['title'] = data['title']
+    else:
+        update['$setOnInsert'] = {'title': 'New Chat'}
+    ack = queue_update(
+        chats_collection,
         {'chat_id': chat_id, 'user_email': user_email},
-        {'$set': chat_doc},
+        update,
         upsert=True
     )
+    # Clients that need the write on disk before continuing ask for it
+    durable = bool(data.get('durable')) or request.args.get('durable') == 'true'
+    if durable:
+        for pending in [a for a in node_acks + [ack] if a is not None]:
+            if not pending.wait():
+                return jsonify({'error': f'Chat save not acknowledged: {pending.error or "timed out"}'}), 500
     return jsonify({
         'message': 'Chat saved successfully',
-        'chat_id': chat_id
+        'chat_id': chat_id,
+        'head': head,
+        'new_nodes': new_nodes,
+        'durable': ack is None or durable
     }), 200
 
 @app.route('/api/history/list', methods=['GET'])
 def list_history():
     if db is None:
         return jsonify({'error': 'Database not available'}), 500
-    user_email = request.args.get('user_email')
+    user_email = resolve_user_email(request.args.get('user_email'))
     if not user_email:
         return jsonify({'error': 'User email required'}), 400
+    sync_writes('chats')
     chats = list(chats_collection.find(
         {'user_email': user_email}
     ).sort('created_at', -1))
+    loaded = chat_tree.load_chats(user_email, chats)
     formatted_chats = []
     for chat in chats:
         formatted_chats.append({
             'id': chat['chat_id'],
             'title': chat['title'],
-            'messages': chat['messages'],
+            'messages': chat_messages(chat, loaded),
+            'head': chat.get('head'),
             'timestamp': chat['created_at'].isoformat() if isinstance(chat['created_at'], datetime) else chat['created_at']
         })
-    return jsonify({'chats': formatted_chats}), 200
+    return compressed_jsonify({'chats': formatted_chats})
 
 @app.route('/api/history/delete', methods=['DELETE'])
 def delete_history():
     if db is None:
         return jsonify({'error': 'Database not available'}), 500
-    user_email = request.args.get('user_email')
+    user_email = resolve_user_email(request.args.get('user_email'))
     chat_id = request.args.get('chat_id')
     if not user_email or not chat_id:
         return jsonify({'error': 'User email and chat ID required'}), 400
+    sync_writes('chats')
     result = chats_collection.delete_one({
         'chat_id': chat_id,
         'user_email': user_email
     })
     if result.deleted_count == 0:
         return jsonify({'error': 'Chat not found'}), 404
+    chat_tree.delete_chat(user_email, chat_id)
+    count_change(chats=-1)
     return jsonify({'message': 'Chat deleted successfully'}), 200
 
+@app.route('/api/history/branches', methods=['GET'])
+def list_branches():
+    if db is None:
+        return jsonify({'error': 'Database not available'}), 500
+    user_email = resolve_user_email(request.args.get('user_email'))
+    chat_id = request.args.get('chat_id')
+    if not user_email or not chat_id:
+        return jsonify({'error': 'User email and chat ID required'}), 400
+    sync_writes('chats')
+    chat = chats_collection.find_one({'chat_id': chat_id, 'user_email': user_email})
+    if chat is None:
+        return jsonify({'error': 'Chat not found'}), 404
+    return jsonify({
+        'chat_id': chat_id,
+        'head': chat.get('head'),
+        'branches': chat_tree.branches(user_email, chat_id, chat.get('head'))
+    }), 200
+
+@app.route('/api/history/checkout', methods=['POST'])
+def checkout_branch():
+    """Move a chat's head to another node, e.g. back to the branch before an edit"""
+    if db is None:
+        return jsonify({'error': 'Database not available'}), 500
+    data = request.json
+    user_email = resolve_user_email(data.get('user_email'))
+    chat_id = data.get('chat_id')
+    head = data.get('head')
+    if not user_email or not chat_id or not head:
+        return jsonify({'error': 'User email, chat ID, and head node required'}), 400
+    if not chat_tree.exists(user_email, chat_id, head):
+        return jsonify({'error': 'Node not found in this chat'}), 404
+    sync_writes('chats')
+    result = chats_collection.update_one(
+        {'chat_id': chat_id, 'user_email': user_email},
+        {'$set': {'head': head, 'updated_at': datetime.utcnow()}}
+    )
+    if result.matched_count == 0:
+        return jsonify({'error': 'Chat not found'}), 404
+    return jsonify({
+        'chat_id': chat_id,
+        'head': head,
+        'messages': chat_tree.load_path(user_email, chat_id, head)
+    }), 200
+
 @app.route('/api/history/rename', methods=['PUT'])
 def rename_history():
     if db is None:
         return jsonify({'error': 'Database not available'}), 500
     data = request.json
-    user_email = data.get('user_email')
+    user_email = resolve_user_email(data.get('user_email'))
     chat_id = data.get('chat_id')
     new_title = data.get('title')
     if not user_email or not chat_id or not new_title:
         return jsonify({'error': 'User email, chat ID, and new title required'}), 400
+    sync_writes('chats')
     result = chats_collection.update_one(
         {'chat_id': chat_id, 'user_email': user_email},
         {'$set': {'title': new_title, 'updated_at': datetime.utcnow()}}
@@ -915,16 +1958,18 @@ def rename_history():
 def export_history():
     if db is None:
         return jsonify({'error': 'Database not available'}), 500
-    user_email = request.args.get('user_email')
+    user_email = resolve_user_email(request.args.get('user_email'))
     if not user_email:
         return jsonify({'error': 'User email required'}), 400
+    sync_writes('chats')
     chats = list(chats_collection.find({'user_email': user_email}))
+    loaded = chat_tree.load_chats(user_email, chats)
     formatted_chats = []
     for chat in chats:
         formatted_chats.append({
             'id': chat['chat_id'],
             'title': chat['title'],
-            'messages': chat['messages'],
+            'messages': chat_messages(chat, loaded),
             'timestamp': chat['created_at'].isoformat() if isinstance(chat['created_at'], datetime) else chat['created_at']
         })
     export_data = {
@@ -932,36 +1977,107 @@ def export_history():
         'exported_at': datetime.utcnow().isoformat(),
         'chats': formatted_chats
     }
-    return jsonify(export_data), 200
+    return compressed_jsonify(export_data)
 
 @app.route('/api/history/clear', methods=['DELETE'])
 def clear_history():
     if db is None:
         return jsonify({'error': 'Database not available'}), 500
-    user_email = request.args.get('user_email')
+    user_email = resolve_user_email(request.args.get('user_email'))
     if not user_email:
         return jsonify({'error': 'User email required'}), 400
+    sync_writes('chats')
     result = chats_collection.delete_many({'user_email': user_email})
+    chat_tree.delete_user(user_email)
+    count_change(chats=-result.deleted_count)
     return jsonify({
         'message': f'Deleted {result.deleted_count} chats',
         'count': result.deleted_count
     }), 200
 
+# ==================== STARTUP ====================
+
+preload_state = {'status': 'pending', 'models': {}}
+_background_started = False
+
+def preload_models():
+    """Page model weights into memory and load the configured models before the first user arrives"""
+    plan = startup.get_preload_plan()
+    if not plan or not LLAMA_AVAILABLE:
+        preload_state['status'] = 'done'
+        return
+    preload_state['status'] = 'running'
+    model_folder = os.path.abspath(app.config['MODEL_FOLDER'])
+    for role, model_name, n_ctx, n_gpu_layers in plan:
+        preload_state['models'][model_name] = 'warming'
+        model_path = os.path.join(model_folder, get_windows_safe_path(model_name))
+        try:
+            started = time.time()
+            size = startup.warm_model_file(model_path)
+            print(f"✓ Warmed {model_name} ({size / (1024**3):.2f} GB) in {time.time() - started:.1f}s")
+            if role == 'warm':
+                preload_state['models'][model_name] = 'warm'
+                continue
+            preload_state['models'][model_name] = 'loading'
+            with model_lock, inference_lock:
+                result, status = load_model_file(model_name, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, role=role)
+            if status == 200:
+                preload_state['models'][model_name] = 'loaded'
+            else:
+                preload_state['models'][model_name] = f"failed: {result.get('error')}"
+        except Exception as e:
+            print(f"⚠️  Preload of {model_name} failed: {e}")
+            preload_state['models'][model_name] = f'failed: {e}'
+    preload_state['status'] = 'done'
+
+def start_background_tasks():
+    global _background_started
+    if _background_started:
+        return
+    _background_started = True
+    threading.Thread(target=connect_database, name='mongo-connect', daemon=True).start()
+    threading.Thread(target=preload_models, name='model-preload', daemon=True).start()
+    batch_runner.start()
+
 # ==================== UTILITY ROUTES ====================
 
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    # Unlike /api/health this only returns 200 once startup work has finished
+    ready = db_status != 'connecting' and preload_state['status'] == 'done'
+    return jsonify({
+        'ready': ready,
+        'database': db_status,
+        'preload': preload_state,
+        'model_loaded': current_model is not None,
+        'model_name': current_model_name
+    }), 200 if ready else 503
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    mongo_status = 'connected' if db is not None else 'disconnected'
+    mongo_status = db_status
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.utcnow().isoformat(),
         'database': mongo_status,
+        'write_behind_depth': write_behind.depth() if write_behind else 0,
+        'write_behind_retrying': write_behind.retrying() if write_behind else 0,
+        'write_behind_dropped': write_behind.stats['dropped_ops'] if write_behind else 0,
+        'write_behind_last_error': write_behind.stats['last_error'] if write_behind else None,
         'model_loaded': current_model is not None,
         'model_name': current_model_name,
+        'embedding_model_name': embedding_model_name,
+        'active_generations': len(active_generations),
         'llama_available': LLAMA_AVAILABLE,
         'message': 'Backend is running correctly!'
     }), 200
 
+@app.route('/api/storage/write-behind', methods=['GET'])
+def write_behind_metrics():
+    if write_behind is None:
+        return jsonify({'enabled': False}), 200
+    return jsonify(dict(write_behind.metrics(), enabled=True)), 200
+
 @app.route('/api/test', methods=['GET'])
 def test_endpoint():
     return jsonify({
@@ -973,21 +2089,63 @@ def test_endpoint():
 def get_stats():
     if db is None:
         return jsonify({'error': 'Database not available'}), 500
-    total_users = users_collection.count_documents({})
-    total_chats = chats_collection.count_documents({})
-    total_models = models_collection.count_documents({})
-    return jsonify({
-        'total_users': total_users,
-        'total_chats': total_chats,
-        'total_models': total_models
-    }), 200
+    if usage_stats is None:
+        return jsonify({
+            'total_users': users_collection.count_documents({}),
+            'total_chats': chats_collection.count_documents({}),
+            'total_models': models_collection.count_documents({})
+        }), 200
+    if request.args.get('exact') == 'true':
+        # Recount the collections and reset the maintained counters
+        sync_writes(None)
+        usage_stats.seed(db, force=True)
+    return jsonify(usage_stats.totals()), 200
+
+@app.route('/api/stats/usage', methods=['GET'])
+def get_usage_stats():
+    """Token usage over a date range: ?from=&to= (ISO dates, default last 7 days), user_email, group_by
+
+    Requires a session; only USAGE_ADMIN_EMAILS may pick another user_email or
+    query across all users.
+    """
+    if db is None or usage_stats is None:
+        return jsonify({'error': 'Usage analytics not available'}), 500
+    session_user = get_session_user()
+    if not session_user:
+        return jsonify({'error': 'Invalid or expired session token'}), 401
+    try:
+        end = analytics.parse_time(request.args['to']) if request.args.get('to') else datetime.utcnow()
+        start = (analytics.parse_time(request.args['from']) if request.args.get('from')
+                 else end - timedelta(days=7))
+    except ValueError:
+        return jsonify({'error': 'from and to must be ISO dates'}), 400
+    if start >= end:
+        return jsonify({'error': 'from must be before to'}), 400
+    if session_user['email'].lower() in analytics.USAGE_ADMIN_EMAILS:
+        user_email = request.args.get('user_email')
+    else:
+        user_email = session_user['email']
+    sync_writes('usage')
+    try:
+        result = usage_stats.query(start, end, user=user_email, group_by=request.args.get('group_by'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(result), 200
 
 if __name__ == '__main__':
+    # With the debug reloader only the serving child process should connect and preload
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_tasks()
     print("\n" + "="*60)
     print("FLASK BACKEND SERVER")
     print("="*60)
     print(f"llama-cpp-python: {'✓ Available' if LLAMA_AVAILABLE else '✗ Not installed'}")
-    print(f"MongoDB: {'✓ Connected' if db is not None else '✗ Not connected'}")
-    print(f"Server URL: http://localhost:5001")
+    print(f"Database: connecting in background ({storage.STORAGE_BACKEND})")
+    if startup.get_preload_plan():
+        print(f"Preloading: {', '.join(name for _, name, _, _ in startup.get_preload_plan())}")
+    print(f"Server URL: http://localhost:{PORT}")
     print("="*60 + "\n")
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=PORT, debug=True)
+else:
+    # Imported by a WSGI server
+    start_background_tasks()
\ No newline at end of file
@@ -0,0 +1,154 @@
+import os
+import hmac
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+# scrypt cost parameters (memory used is roughly 128 * N * r bytes per hash)
+SCRYPT_N = int(os.getenv('SCRYPT_N', 2 ** 14))
+SCRYPT_R = int(os.getenv('SCRYPT_R', 8))
+SCRYPT_P = int(os.getenv('SCRYPT_P', 1))
+SCRYPT_SALT_BYTES = 16
+SCRYPT_KEY_BYTES = 32
+
+# Hashing runs in its own small pool so logins can't starve inference threads
+AUTH_WORKERS = int(os.getenv('AUTH_WORKERS', 2))
+AUTH_TIMEOUT = float(os.getenv('AUTH_TIMEOUT', 10))
+
+VERIFY_CACHE_SIZE = int(os.getenv('AUTH_VERIFY_CACHE_SIZE', 1024))
+VERIFY_CACHE_TTL = int(os.getenv('AUTH_VERIFY_CACHE_TTL', 300))
+
+SESSION_TTL = int(os.getenv('SESSION_TTL', 7 * 24 * 3600))
+TOKEN_SALT = 'chatbot-session'
+# Keys shipped in examples/defaults; anyone can sign tokens with them
+PLACEHOLDER_SECRET_KEYS = {'', 'your-secret-key-here', 'dev-secret-key-change-in-production'}
+
+_pool = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix='auth')
+_verify_cache = OrderedDict()
+_verify_lock = threading.Lock()
+_cache_key = os.urandom(32)
+
+class AuthBusy(Exception):
+    """The hashing pool did not get to a request within AUTH_TIMEOUT"""
+
+    def __init__(self, retry_after=AUTH_TIMEOUT):
+        super().__init__('Authentication is busy, try again shortly')
+        self.retry_after = retry_after
+
+def _run(fn, *args):
+    future = _pool.submit(fn, *args)
+    try:
+        return future.result(timeout=AUTH_TIMEOUT)
+    except FutureTimeoutError:
+        # Drop it if it has not started; a running KDF finishes on its own
+        future.cancel()
+        raise AuthBusy()
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p,
+        maxmem=256 * n * r + 1024 * 1024, dklen=SCRYPT_KEY_BYTES
+    )
+
+def _hash_password(password):
+    salt = os.urandom(SCRYPT_SALT_BYTES)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+
+def is_legacy_hash(stored):
+    """Old accounts store a bare unsalted SHA-256 hex digest"""
+    return isinstance(stored, str) and len(stored) == 64 and not stored.startswith('scrypt$')
+
+def needs_rehash(stored):
+    if is_legacy_hash(stored):
+        return True
+    try:
+        _, n, r, p, _, _ = stored.split('$')
+        return (int(n), int(r), int(p)) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    except (ValueError, AttributeError):
+        return True
+
+def _verify_password(password, stored):
+    if not stored or password is None:
+        return False
+    if is_legacy_hash(stored):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored)
+    try:
+        _, n, r, p, salt, digest = stored.split('$')
+        expected = base64.b64decode(digest)
+        actual = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    except (ValueError, TypeError):
+        return False
+    return hmac.compare_digest(actual, expected)
+
+def _verify_cache_key(email, password, stored):
+    material = f"{email}\x00{password}\x00{stored}".encode()
+    return hmac.new(_cache_key, material, hashlib.sha256).digest()
+
+def hash_password(password):
+    """Hash a password with scrypt on the auth pool"""
+    return _run(_hash_password, password)
+
+def verify_password(email, password, stored):
+    """Check a password against a stored hash (scrypt or legacy SHA-256).
+
+    Successful checks are remembered for a short TTL, keyed by an HMAC of the
+    credentials and the stored hash, so repeated logins skip the KDF and a
+    password change invalidates the entry.
+    """
+    key = _verify_cache_key(email, password, stored)
+    now = time.time()
+    with _verify_lock:
+        expires = _verify_cache.get(key)
+        if expires is not None:
+            if expires > now:
+                _verify_cache.move_to_end(key)
+                return True
+            del _verify_cache[key]
+
+    ok = _run(_verify_password, password, stored)
+    if ok:
+        with _verify_lock:
+            _verify_cache[key] = now + VERIFY_CACHE_TTL
+            while len(_verify_cache) > VERIFY_CACHE_SIZE:
+                _verify_cache.popitem(last=False)
+    return ok
+
+def clear_verify_cache():
+    with _verify_lock:
+        _verify_cache.clear()
+
+# ==================== SESSION TOKENS ====================
+
+def secret_key_configured(secret_key):
+    return bool(secret_key) and secret_key not in PLACEHOLDER_SECRET_KEYS
+
+def _serializer(secret_key):
+    return URLSafeTimedSerializer(secret_key, salt=TOKEN_SALT)
+
+def issue_token(secret_key, user):
+    """Create a signed stateless session token for a user document; None without a real secret key"""
+    if not secret_key_configured(secret_key):
+        return None
+    return _serializer(secret_key).dumps({
+        'id': str(user['_id']),
+        'username': user.get('username'),
+        'email': user['email']
+    })
+
+def verify_token(secret_key, token, max_age=SESSION_TTL):
+    """Return the token payload, or None if it is invalid or expired"""
+    if not token or not secret_key_configured(secret_key):
+        return None
+    try:
+        return _serializer(secret_key).loads(token, max_age=max_age)
+    except (BadSignature, SignatureExpired):
+        return None
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import uuid
+import queue
+import threading
+
+BATCH_FOLDER = os.getenv('BATCH_FOLDER', 'batches')
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 100000))
+
+class BatchError(Exception):
+    pass
+
+class BatchThrottled(Exception):
+    """Raised by process_item when the owner is out of budget; the item runs again after retry_after seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+def parse_batch_lines(lines):
+    """Validate JSONL input; every line needs `messages`, `id` and `settings` are optional"""
+    items = []
+    seen = set()
+    for line_no, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            raise BatchError(f'Line {line_no}: invalid JSON ({e})')
+        if not isinstance(item, dict) or not isinstance(item.get('messages'), list) or not item['messages']:
+            raise BatchError(f'Line {line_no}: "messages" must be a non-empty list')
+        item_id = str(item.get('id', line_no))
+        if item_id in seen:
+            raise BatchError(f'Line {line_no}: duplicate id {item_id}')
+        seen.add(item_id)
+        items.append({'id': item_id, 'messages': item['messages'], 'settings': item.get('settings') or {}})
+        if len(items) > BATCH_MAX_ITEMS:
+            raise BatchError(f'Batch exceeds {BATCH_MAX_ITEMS} items')
+    if not items:
+        raise BatchError('Batch file is empty')
+    return items
+
+class BatchJob:
+    def __init__(self, job_id, folder):
+        self.id = job_id
+        self.folder = folder
+        self.input_path = os.path.join(folder, 'input.jsonl')
+        self.output_path = os.path.join(folder, 'output.jsonl')
+        self.meta_path = os.path.join(folder, 'job.json')
+        self.meta = {}
+
+    def load_meta(self):
+        with open(self.meta_path, 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        return self.meta
+
+    def save_meta(self, **updates):
+        self.meta.update(updates)
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def completed_ids(self):
+        """The output file doubles as the checkpoint: finished ids are skipped on resume"""
+        done = set()
+        if not os.path.exists(self.output_path):
+            return done
+        with open(self.output_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['id'])
+                except (ValueError, KeyError):
+                    # A line cut short by a crash; the item is simply redone
+                    continue
+        return done
+
+    def status(self):
+        return dict(self.meta, job_id=self.id)
+
+class BatchRunner:
+    """Processes batch jobs one after another on a background worker.
+
+    `process_item(messages, settings, owner)` does the actual generation and returns
+    a result dict, or raises BatchThrottled to pause the job until the owner's
+    budget refills. Items run in prompt order (`prompt_key`) so consecutive
+    prompts share the longest possible prefix and llama.cpp reuses its KV
+    cache instead of re-evaluating shared system prompts and history.
+    """
+
+    def __init__(self, process_item, prompt_key=None, folder=BATCH_FOLDER):
+        self.process_item = process_item
+        self.prompt_key = prompt_key or (lambda item: json.dumps(item['messages']))
+        self.folder = os.path.abspath(folder)
+        self.jobs = {}
+        self._queue = queue.Queue()
+        self._cancelled = set()
+        self._worker = None
+        os.makedirs(self.folder, exist_ok=True)
+
+    def start(self):
+        if self._worker:
+            return
+        self._resume_unfinished()
+        self._worker = threading.Thread(target=self._run, name='batch-worker', daemon=True)
+        self._worker.start()
+
+    def submit(self, lines, owner=None):
+        items = parse_batch_lines(lines)
+        job_id = uuid.uuid4().hex
+        job = BatchJob(job_id, os.path.join(self.folder, job_id))
+        os.makedirs(job.folder)
+        with open(job.input_path, 'w', encoding='utf-8') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+        job.save_meta(status='queued', owner=owner, total=len(items), completed=0, failed=0,
+                      created_at=time.time(), started_at=None, finished_at=None)
+        self.jobs[job_id] = job
+        self._queue.put(job_id)
+        return job
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None and os.path.exists(os.path.join(self.folder, job_id, 'job.json')):
+            job = BatchJob(job_id, os.path.join(self.folder, job_id))
+            job.load_meta()
+            self.jobs[job_id] = job
+        return job
+
+    def cancel(self, job_id):
+        self._cancelled.add(job_id)
+
+    def _pause(self, job, seconds):
+        """Sleep until the job may continue; False if it was cancelled meanwhile"""
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            if job.id in self._cancelled:
+                return False
+            time.sleep(min(1.0, deadline - time.time()))
+        return job.id not in self._cancelled
+
+    def _resume_unfinished(self):
+        for job_id in sorted(os.listdir(self.folder)):
+            job = self.get(job_id)
+            if job and job.meta.get('status') in ('queued', 'running'):
+                print(f"Resuming batch job {job_id} ({job.meta.get('completed', 0)}/{job.meta.get('total')})")
+                self._queue.put(job_id)
+
+    def _run(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run_job(self.jobs[job_id])
+            except Exception as e:
+                print(f"❌ Batch job {job_id} failed: {e}")
+                self.jobs[job_id].save_meta(status='failed', error=str(e), finished_at=time.time())
+
+    def _run_job(self, job):
+        with open(job.input_path, 'r', encoding='utf-8') as f:
+            items = [json.loads(line) for line in f if line.strip()]
+        done = job.completed_ids()
+        pending = sorted((item for item in items if item['id'] not in done), key=self.prompt_key)
+        job.save_meta(status='running', started_at=job.meta.get('started_at') or time.time(),
+                      completed=len(done))
+
+        with open(job.output_path, 'a', encoding='utf-8') as out:
+            for item in pending:
+                record = {'id': item['id']}
+                while True:
+                    if job.id in self._cancelled:
+                        job.save_meta(status='cancelled', finished_at=time.time())
+                        return
+                    try:
+                        record.update(self.process_item(item['messages'], item['settings'], job.meta.get('owner')))
+                    except BatchThrottled as e:
+                        job.save_meta(status='throttled', throttled_reason=str(e),
+                                      resume_at=time.time() + e.retry_after)
+                        self._pause(job, e.retry_after)
+                        continue
+                    except Exception as e:
+                        record['error'] = str(e)
+                        job.meta['failed'] = job.meta.get('failed', 0) + 1
+                    break
+                if job.meta.get('status') == 'throttled':
+                    job.save_meta(status='running', throttled_reason=None, resume_at=None)
+                out.write(json.dumps(record) + '\n')
+                out.flush()
+                job.save_meta(completed=job.meta.get('completed', 0) + 1)
+
+        job.save_meta(status='completed', finished_at=time.time())
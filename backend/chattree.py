@@ -0,0 +1,184 @@
+import json
+import hashlib
+from datetime import datetime
+
+# Node ids per $in query when walking paths
+PATH_QUERY_BATCH = 500
+
+class ChatTreeError(Exception):
+    pass
+
+def node_id(chat_id, user_email, parent_id, message):
+    """Content address of a message at a position in a chat.
+
+    The parent id is part of the hash, so a node id identifies the whole path
+    from the root: two branches share exactly the nodes of their common
+    prefix, and a node id can key a prefix KV cache entry.
+    """
+    canonical = json.dumps(message, sort_keys=True, ensure_ascii=False, default=str)
+    digest = hashlib.sha256()
+    for part in (chat_id, user_email, parent_id or '', canonical):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:32]
+
+def build_path(chat_id, user_email, messages, parent_id=None):
+    """(node_id, parent_id, message) for each message, chained under parent_id"""
+    path = []
+    for message in messages:
+        if isinstance(message, dict):
+            # Loaded messages carry their node id; it is not part of the content
+            message = {key: value for key, value in message.items() if key != 'id'}
+        current = node_id(chat_id, user_email, parent_id, message)
+        path.append((current, parent_id, message))
+        parent_id = current
+    return path
+
+class ChatTree:
+    """Chats stored as a tree of message nodes instead of one messages array.
+
+    Each chat document keeps a `head` pointer to the leaf of its active
+    branch. Editing an earlier message or regenerating a reply only adds the
+    nodes after the fork; the shared prefix is stored once.
+
+    New nodes are written through `update`, which the app points at the
+    write-behind queue, and `sync` makes those queued writes visible before
+    the tree is read.
+    """
+
+    def __init__(self, nodes_collection, codec=None, compress=True, update=None, sync=None):
+        self.nodes = nodes_collection
+        self.codec = codec
+        self.compress = compress
+        self.update = update or (lambda collection, filter_doc, doc, upsert: collection.update_one(
+            filter_doc, doc, upsert=upsert))
+        self.sync = sync or (lambda: None)
+
+    def _pack(self, message):
+        return self.codec.compress_message(message) if self.codec and self.compress else message
+
+    def _unpack(self, message):
+        return self.codec.decompress_message(message) if self.codec else message
+
+    def save_path(self, chat_id, user_email, messages, parent_id=None):
+        """Queue the nodes of `messages` that do not exist yet; returns (head_id, new_node_count, acks)"""
+        self.sync()
+        stored = {str(node['_id']) for node in self.nodes.find({'user_email': user_email, 'chat_id': chat_id})}
+        if parent_id and parent_id not in stored:
+            raise ChatTreeError(f'Unknown parent node: {parent_id}')
+        path = build_path(chat_id, user_email, messages, parent_id)
+        if not path:
+            return parent_id, 0, []
+        # A node's id covers its ancestors, so the first existing node from the
+        # leaf backwards means everything before it is already stored
+        new_nodes = []
+        for current, parent, message in reversed(path):
+            if current in stored:
+                break
+            new_nodes.append((current, parent, message))
+        now = datetime.utcnow()
+        acks = [self.update(self.nodes, {'_id': current}, {'$setOnInsert': {
+            'chat_id': chat_id,
+            'user_email': user_email,
+            'parent_id': parent,
+            'message': self._pack(message),
+            'created_at': now
+        }}, True) for current, parent, message in reversed(new_nodes)]
+        return path[-1][0], len(new_nodes), acks
+
+    def _by_id(self, user_email, chat_id):
+        self.sync()
+        return {str(node['_id']): node for node in self.nodes.find({'user_email': user_email, 'chat_id': chat_id})}
+
+    def _fetch_paths(self, user_email, heads):
+        """Nodes on the paths from each head to its root, and nothing from other branches.
+
+        All paths are walked up one level per query, so loading many chats
+        costs as many queries as the deepest chat has messages.
+        """
+        self.sync()
+        nodes = {}
+        frontier = {head for head in heads if head}
+        while frontier:
+            frontier = list(frontier)
+            for start in range(0, len(frontier), PATH_QUERY_BATCH):
+                for node in self.nodes.find({'_id': {'$in': frontier[start:start + PATH_QUERY_BATCH]},
+                                             'user_email': user_email}):
+                    nodes[str(node['_id'])] = node
+            frontier = {node['parent_id'] for node in map(nodes.get, frontier)
+                        if node is not None and node.get('parent_id') and node['parent_id'] not in nodes}
+        return nodes
+
+    @staticmethod
+    def _walk(nodes, head_id):
+        path = []
+        current = head_id
+        while current:
+            node = nodes.get(current)
+            if node is None:
+                raise ChatTreeError(f'Missing node {current} on the path to {head_id}')
+            path.append(node)
+            current = node.get('parent_id')
+        path.reverse()
+        return path
+
+    def load_path(self, user_email, chat_id, head_id, nodes=None):
+        """Messages from the root to head_id, each with its node `id`"""
+        if nodes is None:
+            nodes = self._fetch_paths(user_email, [head_id])
+        return [dict(self._unpack(node['message']), id=str(node['_id'])) for node in self._walk(nodes, head_id)]
+
+    def load_chats(self, user_email, chats):
+        """Active-branch messages for many chats of one user, reading only their active paths"""
+        chats = [chat for chat in chats if chat.get('head')]
+        nodes = self._fetch_paths(user_email, [chat['head'] for chat in chats])
+        return {chat['chat_id']: self.load_path(user_email, chat['chat_id'], chat['head'], nodes)
+                for chat in chats}
+
+    def branches(self, user_email, chat_id, head_id):
+        """Every leaf in the chat's tree, i.e. every branch that can be checked out"""
+        nodes = self._by_id(user_email, chat_id)
+        parents = {node.get('parent_id') for node in nodes.values()}
+        depths = self._depths(nodes)
+        leaves = []
+        for leaf_id, node in nodes.items():
+            if leaf_id in parents:
+                continue
+            last = self._unpack(node['message'])
+            leaves.append({
+                'head': leaf_id,
+                'depth': depths[leaf_id],
+                'last_message': last,
+                'active': leaf_id == head_id,
+                'created_at': node['created_at'].isoformat() if isinstance(node['created_at'], datetime) else node['created_at']
+            })
+        leaves.sort(key=lambda leaf: str(leaf['created_at']))
+        return leaves
+
+    @staticmethod
+    def _depths(nodes):
+        """Depth of every node in one pass, each ancestor chain resolved once"""
+        depths = {}
+        for node_id in nodes:
+            chain = []
+            current = node_id
+            while current in nodes and current not in depths:
+                chain.append(current)
+                current = nodes[current].get('parent_id')
+            depth = depths.get(current, 0)
+            for pending in reversed(chain):
+                depth += 1
+                depths[pending] = depth
+        return depths
+
+    def exists(self, user_email, chat_id, node):
+        self.sync()
+        return self.nodes.find_one({'_id': node, 'chat_id': chat_id, 'user_email': user_email}) is not None
+
+    def delete_chat(self, user_email, chat_id):
+        self.sync()
+        return self.nodes.delete_many({'user_email': user_email, 'chat_id': chat_id}).deleted_count
+
+    def delete_user(self, user_email):
+        self.sync()
+        return self.nodes.delete_many({'user_email': user_email}).deleted_count
@@ -0,0 +1,133 @@
+import os
+import gzip
+import zlib
+
+# zstd and brotli are optional; zlib/gzip from the standard library always work
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    zstandard = None
+    ZSTD_AVAILABLE = False
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    brotli = None
+    BROTLI_AVAILABLE = False
+
+MESSAGE_COMPRESSION_ENABLED = os.getenv('MESSAGE_COMPRESSION_ENABLED', 'true').lower() == 'true'
+MESSAGE_COMPRESSION_THRESHOLD = int(os.getenv('MESSAGE_COMPRESSION_THRESHOLD', 1024))
+MESSAGE_COMPRESSION_LEVEL = int(os.getenv('MESSAGE_COMPRESSION_LEVEL', 6))
+# Optional zstd dictionary trained on chat messages (python storage_tools.py train-dict)
+COMPRESSION_DICT_PATH = os.getenv('COMPRESSION_DICT_PATH', os.path.join('data', 'messages.zdict'))
+RESPONSE_COMPRESSION_MIN_SIZE = int(os.getenv('RESPONSE_COMPRESSION_MIN_SIZE', 1024))
+
+class MessageCodec:
+    """Compresses large message bodies at rest.
+
+    A compressed message keeps its other fields and replaces `content` with
+    `content_z` (bytes) plus `content_codec`. Codecs: 'zstd', 'zstd-dict:<id>'
+    (shared dictionary, best for many short-ish similar messages) and 'zlib'
+    when zstandard is not installed.
+    """
+
+    def __init__(self, threshold=MESSAGE_COMPRESSION_THRESHOLD, level=MESSAGE_COMPRESSION_LEVEL,
+                 dict_path=COMPRESSION_DICT_PATH):
+        self.threshold = threshold
+        self.level = level
+        self.dictionary = None
+        self.dict_id = None
+        if ZSTD_AVAILABLE and dict_path and os.path.exists(dict_path):
+            with open(dict_path, 'rb') as f:
+                self.dictionary = zstandard.ZstdCompressionDict(f.read())
+            self.dict_id = self.dictionary.dict_id()
+            print(f"✓ Loaded message compression dictionary {self.dict_id}")
+
+    def _compress(self, data):
+        if ZSTD_AVAILABLE:
+            if self.dictionary is not None:
+                compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.dictionary)
+                return compressor.compress(data), f'zstd-dict:{self.dict_id}'
+            return zstandard.ZstdCompressor(level=self.level).compress(data), 'zstd'
+        return zlib.compress(data, self.level), 'zlib'
+
+    def _decompress(self, data, codec):
+        if codec == 'zlib':
+            return zlib.decompress(data)
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError(f'Message stored with {codec} but zstandard is not installed')
+        if codec.startswith('zstd-dict:'):
+            if self.dictionary is None or codec != f'zstd-dict:{self.dict_id}':
+                raise RuntimeError(f'Compression dictionary for {codec} is not loaded')
+            return zstandard.ZstdDecompressor(dict_data=self.dictionary).decompress(data)
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    def compress_message(self, message):
+        content = message.get('content') if isinstance(message, dict) else None
+        if not isinstance(content, str) or len(content) < self.threshold:
+            return message
+        raw = content.encode('utf-8')
+        packed, codec = self._compress(raw)
+        if len(packed) >= len(raw):
+            return message
+        compressed = {key: value for key, value in message.items() if key != 'content'}
+        compressed['content_z'] = packed
+        compressed['content_codec'] = codec
+        return compressed
+
+    def decompress_message(self, message):
+        if not isinstance(message, dict) or 'content_z' not in message:
+            return message
+        restored = {key: value for key, value in message.items() if key not in ('content_z', 'content_codec')}
+        restored['content'] = self._decompress(bytes(message['content_z']), message['content_codec']).decode('utf-8')
+        return restored
+
+    def compress_messages(self, messages):
+        return [self.compress_message(message) for message in messages]
+
+    def decompress_messages(self, messages):
+        return [self.decompress_message(message) for message in messages or []]
+
+def train_dictionary(samples, size=112640):
+    """Train a zstd dictionary from sample message bodies"""
+    if not ZSTD_AVAILABLE:
+        raise RuntimeError('zstandard is not installed')
+    return zstandard.train_dictionary(size, [sample.encode('utf-8') for sample in samples]).as_bytes()
+
+# ==================== RESPONSE COMPRESSION ====================
+
+def _accepted_encodings(header):
+    accepted = {}
+    for part in (header or '').split(','):
+        pieces = part.strip().split(';')
+        name = pieces[0].strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in pieces[1:]:
+            if param.strip().startswith('q='):
+                try:
+                    quality = float(param.strip()[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+def choose_encoding(accept_encoding):
+    """Pick the best encoding the client accepts: zstd, then br, then gzip"""
+    accepted = _accepted_encodings(accept_encoding)
+    for name, available in (('zstd', ZSTD_AVAILABLE), ('br', BROTLI_AVAILABLE), ('gzip', True)):
+        if available and accepted.get(name, accepted.get('*', 0)) > 0:
+            return name
+    return None
+
+def compress_body(body, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
@@ -0,0 +1,392 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+import requests
+
+DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', 4))
+DOWNLOAD_MAX_CONNECTIONS = int(os.getenv('DOWNLOAD_MAX_CONNECTIONS', 16))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_MIN_SEGMENT = 8 * 1024 * 1024
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_RETRIES = 3
+
+class DownloadError(Exception):
+    pass
+
+class DownloadJob:
+    """Fetches one file with parallel range requests into `<file>.part`.
+
+    Segment progress is persisted in `<file>.part.json` so an interrupted job
+    resumes where it stopped. The SHA-256 is computed in file order while the
+    segments are still downloading, and the GGUF magic is checked as soon as
+    the first bytes arrive so a wrong URL fails fast.
+    """
+
+    def __init__(self, url, filepath, auth_token=None, expected_sha256=None,
+                 connections=DOWNLOAD_CONNECTIONS, session=None, on_complete=None):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.filepath = filepath
+        self.filename = os.path.basename(filepath)
+        self.part_path = filepath + '.part'
+        self.state_path = filepath + '.part.json'
+        self.auth_token = auth_token
+        self.expected_sha256 = expected_sha256.lower() if expected_sha256 else None
+        self.connections = max(1, min(int(connections), DOWNLOAD_MAX_CONNECTIONS))
+        self.session = session or requests.Session()
+        self.on_complete = on_complete
+
+        self.status = 'queued'
+        self.error = None
+        self.total_size = None
+        self.sha256 = None
+        self.resumed_bytes = 0
+        self.segments = []
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._thread = None
+
+    # ---------- public ----------
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f'download-{self.id[:8]}', daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def progress(self):
+        with self._lock:
+            downloaded = sum(seg['done'] for seg in self.segments)
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0
+        speed = (downloaded - self.resumed_bytes) / elapsed if elapsed > 0 else 0
+        return {
+            'job_id': self.id,
+            'url': self.url,
+            'filename': self.filename,
+            'status': self.status,
+            'error': self.error,
+            'total_size': self.total_size,
+            'downloaded': downloaded,
+            'percent': round(downloaded * 100 / self.total_size, 2) if self.total_size else None,
+            'speed_bytes_per_sec': int(speed),
+            'connections': len(self.segments),
+            'resumed_bytes': self.resumed_bytes,
+            'sha256': self.sha256
+        }
+
+    # ---------- internals ----------
+
+    def _headers(self, extra=None):
+        headers = dict(extra or {})
+        if self.auth_token:
+            headers['Authorization'] = f'Bearer {self.auth_token}'
+        return headers
+
+    def _probe(self):
+        """Find the file size and whether the server honours byte ranges"""
+        response = self.session.get(self.url, headers=self._headers({'Range': 'bytes=0-0'}),
+                                    stream=True, timeout=DOWNLOAD_TIMEOUT, allow_redirects=True)
+        try:
+            if response.status_code == 206:
+                content_range = response.headers.get('Content-Range', '')
+                total = content_range.rsplit('/', 1)[-1]
+                if total.isdigit():
+                    return int(total), True
+            if response.status_code == 200:
+                length = response.headers.get('Content-Length')
+                return (int(length) if length and length.isdigit() else None), False
+            raise DownloadError(f'Server returned HTTP {response.status_code}')
+        finally:
+            response.close()
+
+    def _plan_segments(self, total_size, ranges):
+        if not ranges or not total_size:
+            return [{'start': 0, 'end': (total_size or 0) - 1, 'done': 0}]
+        count = max(1, min(self.connections, total_size // DOWNLOAD_MIN_SEGMENT or 1))
+        step = total_size // count
+        segments = []
+        for i in range(count):
+            start = i * step
+            end = total_size - 1 if i == count - 1 else (i + 1) * step - 1
+            segments.append({'start': start, 'end': end, 'done': 0})
+        return segments
+
+    def _load_state(self, total_size):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get('url') != self.url or state.get('total_size') != total_size:
+            return None
+        if not os.path.exists(self.part_path) or os.path.getsize(self.part_path) != total_size:
+            return None
+        return state.get('segments')
+
+    def _save_state(self):
+        with self._lock:
+            state = {'url': self.url, 'total_size': self.total_size,
+                     'segments': [dict(seg) for seg in self.segments]}
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _fetch_segment(self, segment, ranged):
+        for attempt in range(DOWNLOAD_RETRIES):
+            if self._cancel.is_set() or self.error:
+                return
+            offset = segment['start'] + segment['done']
+            if ranged and offset > segment['end']:
+                return
+            headers = self._headers({'Range': f"bytes={offset}-{segment['end']}"} if ranged else None)
+            try:
+                with self.session.get(self.url, headers=headers, stream=True,
+                                      timeout=DOWNLOAD_TIMEOUT) as response:
+                    if response.status_code not in (200, 206) or (ranged and response.status_code != 206):
+                        raise DownloadError(f'Server returned HTTP {response.status_code}')
+                    with open(self.part_path, 'r+b') as f:
+                        f.seek(offset)
+                        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            if self._cancel.is_set() or self.error:
+                                return
+                            f.write(chunk)
+                            # The hasher and the resume state read `done`; the bytes must be on disk first
+                            f.flush()
+                            with self._lock:
+                                segment['done'] += len(chunk)
+                return
+            except (requests.RequestException, DownloadError) as e:
+                if not ranged or attempt == DOWNLOAD_RETRIES - 1:
+                    with self._lock:
+                        self.error = self.error or f'Segment {segment["start"]}-{segment["end"]} failed: {e}'
+                    return
+                time.sleep(1 + attempt)
+
+    def _contiguous_bytes(self):
+        """Bytes from offset 0 that are already on disk"""
+        with self._lock:
+            frontier = 0
+            for seg in self.segments:
+                frontier = seg['start'] + seg['done']
+                if seg['start'] + seg['done'] <= seg['end']:
+                    break
+            return frontier
+
+    def _run(self):
+        self.started_at = time.time()
+        self.status = 'running'
+        try:
+            total_size, ranged = self._probe()
+            self.total_size = total_size
+
+            segments = self._load_state(total_size) if ranged else None
+            if segments:
+                self.resumed_bytes = sum(seg['done'] for seg in segments)
+                print(f"Resuming download of {self.filename} at {self.resumed_bytes} bytes")
+            else:
+                segments = self._plan_segments(total_size, ranged)
+                with open(self.part_path, 'wb') as f:
+                    if total_size:
+                        f.truncate(total_size)
+            self.segments = segments
+
+            workers = [threading.Thread(target=self._fetch_segment, args=(seg, ranged), daemon=True)
+                       for seg in self.segments]
+            for worker in workers:
+                worker.start()
+
+            # Hash in file order while segments stream in; check the GGUF header early
+            hasher = hashlib.sha256()
+            hashed = 0
+            header_checked = False
+            last_saved = time.time()
+            # Unbuffered: a buffered reader would keep bytes read past the
+            # frontier and serve them as stale zeros after the next seek
+            with open(self.part_path, 'rb', buffering=0) as f:
+                while True:
+                    alive = any(worker.is_alive() for worker in workers)
+                    frontier = self._contiguous_bytes()
+                    if not header_checked and frontier >= 4:
+                        f.seek(0)
+                        if f.read(4) != b'GGUF':
+                            self.error = 'Not a valid GGUF file (invalid magic number)'
+                        header_checked = True
+                    f.seek(hashed)
+                    while hashed < frontier:
+                        block = f.read(min(DOWNLOAD_CHUNK_SIZE, frontier - hashed))
+                        if not block:
+                            break
+                        hasher.update(block)
+                        hashed += len(block)
+                    if ranged and time.time() - last_saved > 1:
+                        self._save_state()
+                        last_saved = time.time()
+                    if not alive:
+                        break
+                    time.sleep(0.1)
+
+            if ranged:
+                self._save_state()
+            if self._cancel.is_set():
+                self.status = 'cancelled'
+                return
+            if self.error:
+                raise DownloadError(self.error)
+            if total_size is not None and hashed != total_size:
+                raise DownloadError(f'Incomplete download ({hashed} of {total_size} bytes)')
+
+            self.sha256 = hasher.hexdigest()
+            if self.expected_sha256 and self.sha256 != self.expected_sha256:
+                self._discard()
+                raise DownloadError(f'SHA-256 mismatch: expected {self.expected_sha256}, got {self.sha256}')
+
+            os.replace(self.part_path, self.filepath)
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+            if self.on_complete:
+                self.on_complete(self)
+            self.status = 'completed'
+            print(f"✓ Downloaded {self.filename} ({hashed / (1024**3):.2f} GB)")
+        except Exception as e:
+            self.error = str(e)
+            self.status = 'failed'
+            print(f"❌ Download of {self.filename} failed: {e}")
+            # A wrong file is never worth resuming
+            if 'GGUF' in self.error:
+                self._discard()
+        finally:
+            self.finished_at = time.time()
+
+    def _discard(self):
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class DownloadManager:
+    def __init__(self):
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, url, filepath, **kwargs):
+        with self._lock:
+            for job in self.jobs.values():
+                if job.filepath == filepath and job.status in ('queued', 'running'):
+                    raise DownloadError(f'{job.filename} is already being downloaded (job {job.id})')
+            job = DownloadJob(url, filepath, **kwargs)
+            self.jobs[job.id] = job
+        job.start()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self):
+        return [job.progress() for job in self.jobs.values()]
+
+# ==================== SELF-CHECK ====================
+
+def _selfcheck():
+    """Exercise ranges, retry, resume and checksums against a local HTTP stand-in.
+
+        python downloader.py
+    """
+    import tempfile
+    import shutil
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    payload = b'GGUF' + os.urandom(3 * DOWNLOAD_MIN_SEGMENT + 12345)
+    expected = hashlib.sha256(payload).hexdigest()
+    behaviour = {'drop_once': False, 'delay': 0.0, 'body': payload}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = behaviour['body']
+            start, end = 0, len(body) - 1
+            ranged = 'Range' in self.headers
+            if ranged:
+                first, last = self.headers['Range'].split('=', 1)[1].split('-')
+                start, end = int(first), min(int(last or end), end)
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            data = body[start:end + 1]
+            # Drop a large response halfway once, like a flaky connection
+            if behaviour['drop_once'] and len(data) > DOWNLOAD_CHUNK_SIZE:
+                behaviour['drop_once'] = False
+                self.wfile.write(data[:len(data) // 2])
+                return
+            try:
+                for i in range(0, len(data), 256 * 1024):
+                    self.wfile.write(data[i:i + 256 * 1024])
+                    time.sleep(behaviour['delay'])
+            except (BrokenPipeError, ConnectionResetError):
+                # The client cancelled
+                pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/model.gguf'
+    folder = tempfile.mkdtemp(prefix='download_check_')
+    try:
+        def fetch(name, **kwargs):
+            job = DownloadJob(url, os.path.join(folder, name), **kwargs)
+            job.start()
+            job.wait()
+            return job
+
+        job = fetch('parallel.gguf', connections=4, expected_sha256=expected)
+        assert job.status == 'completed' and job.sha256 == expected, job.progress()
+        assert len(job.segments) == 3, 'expected one segment per 8 MB'
+        print(f"✓ parallel ranges ({len(job.segments)} segments), sha256 verified")
+
+        behaviour['drop_once'] = True
+        job = fetch('retry.gguf', connections=2, expected_sha256=expected)
+        assert job.status == 'completed', job.progress()
+        print("✓ dropped connection retried")
+
+        behaviour['delay'] = 0.02
+        job = DownloadJob(url, os.path.join(folder, 'resume.gguf'), connections=2)
+        job.start()
+        time.sleep(0.5)
+        job.cancel()
+        job.wait()
+        assert job.status == 'cancelled', job.progress()
+        behaviour['delay'] = 0.0
+        job = fetch('resume.gguf', connections=2, expected_sha256=expected)
+        assert job.status == 'completed' and job.resumed_bytes > 0, job.progress()
+        print(f"✓ resumed at {job.resumed_bytes} bytes, sha256 verified")
+
+        job = fetch('mismatch.gguf', expected_sha256='0' * 64)
+        assert job.status == 'failed' and 'SHA-256' in job.error
+        assert not os.path.exists(job.part_path)
+        print("✓ checksum mismatch rejected and discarded")
+
+        behaviour['body'] = b'NOPE' + payload[4:]
+        job = fetch('notgguf.gguf')
+        assert job.status == 'failed' and 'GGUF' in job.error
+        print("✓ non-GGUF payload rejected")
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == '__main__':
+    _selfcheck()
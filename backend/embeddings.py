@@ -0,0 +1,97 @@
+import os
+import sys
+import base64
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 10000))
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 32))
+EMBEDDING_MAX_INPUTS = int(os.getenv('EMBEDDING_MAX_INPUTS', 2048))
+
+def to_float32_bytes(vector):
+    """Pack a vector as little-endian float32"""
+    packed = array('f', vector)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+def from_float32_bytes(data):
+    unpacked = array('f')
+    unpacked.frombytes(data)
+    if sys.byteorder == 'big':
+        unpacked.byteswap()
+    return unpacked.tolist()
+
+class EmbeddingCache:
+    """LRU of packed float32 vectors keyed by a hash of (model, text)"""
+
+    def __init__(self, max_entries=EMBEDDING_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_name, text):
+        return hashlib.sha256(f"{model_name}\x00{text}".encode('utf-8')).digest()
+
+    def get(self, key):
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                'hits': self.hits, 'misses': self.misses}
+
+def embed_texts(model, model_name, texts, cache, lock):
+    """Return packed float32 vectors for texts, computing only cache misses.
+
+    Misses are deduplicated and sent to llama.cpp in batches of
+    EMBEDDING_BATCH_SIZE so many short inputs share one decode call.
+    """
+    keys = [EmbeddingCache.key(model_name, text) for text in texts]
+    vectors = [cache.get(key) for key in keys]
+    missing = OrderedDict()
+    for i, vector in enumerate(vectors):
+        if vector is None:
+            missing.setdefault(keys[i], texts[i])
+
+    computed = {}
+    pending = list(missing.items())
+    for start in range(0, len(pending), EMBEDDING_BATCH_SIZE):
+        chunk = pending[start:start + EMBEDDING_BATCH_SIZE]
+        with lock:
+            results = model.embed([text for _, text in chunk])
+        for (key, _), result in zip(chunk, results):
+            packed = to_float32_bytes(result)
+            cache.put(key, packed)
+            computed[key] = packed
+
+    cached_count = sum(1 for vector in vectors if vector is not None)
+    vectors = [vector if vector is not None else computed[key] for key, vector in zip(keys, vectors)]
+    return vectors, cached_count
+
+def encode_vectors(vectors, encoding_format):
+    if encoding_format == 'float':
+        return [from_float32_bytes(vector) for vector in vectors]
+    return [base64.b64encode(vector).decode('ascii') for vector in vectors]
@@ -0,0 +1,82 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+GRAMMAR_CACHE_SIZE = int(os.getenv('GRAMMAR_CACHE_SIZE', 64))
+
+class GrammarError(Exception):
+    pass
+
+class GrammarCache:
+    """Compiled llama.cpp grammars keyed by a hash of the canonical schema, LRU evicted"""
+
+    def __init__(self, max_entries=GRAMMAR_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(kind, schema):
+        canonical = json.dumps(schema, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(f"{kind}:{canonical}".encode('utf-8')).hexdigest()
+
+    def get_or_compile(self, kind, schema):
+        key = self.key(kind, schema)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        compiled = _compile(kind, schema)
+        with self._lock:
+            self._entries[key] = compiled
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return compiled
+
+    def stats(self):
+        return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                'hits': self.hits, 'misses': self.misses}
+
+def _compile(kind, schema):
+    from llama_cpp.llama_grammar import LlamaGrammar, JSON_GBNF
+    try:
+        if kind == 'json_object':
+            return LlamaGrammar.from_string(JSON_GBNF, verbose=False)
+        return LlamaGrammar.from_json_schema(json.dumps(schema), verbose=False)
+    except Exception as e:
+        raise GrammarError(f'Could not compile JSON schema: {e}')
+
+def get_constraint(settings):
+    """Read the requested output constraint as (kind, schema), or None.
+
+    Accepts OpenAI-style response_format ({"type": "json_object"} or
+    {"type": "json_schema", "json_schema": {"schema": {...}}}) or a bare
+    json_schema setting.
+    """
+    response_format = settings.get('response_format')
+    schema = settings.get('json_schema')
+    if response_format:
+        if not isinstance(response_format, dict):
+            raise GrammarError('response_format must be an object')
+        kind = response_format.get('type')
+        if kind == 'text':
+            return None
+        if kind == 'json_object':
+            return 'json_object', None
+        if kind == 'json_schema':
+            wrapper = response_format.get('json_schema') or {}
+            schema = wrapper.get('schema', wrapper) if isinstance(wrapper, dict) else None
+        else:
+            raise GrammarError(f'Unsupported response_format type: {kind}')
+    if schema is None:
+        return None
+    if not isinstance(schema, dict):
+        raise GrammarError('json_schema must be an object')
+    return 'json_schema', schema
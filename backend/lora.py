@@ -0,0 +1,128 @@
+import os
+import threading
+from collections import OrderedDict
+
+LORA_CACHE_SIZE = int(os.getenv('LORA_CACHE_SIZE', 4))
+
+class LoraError(Exception):
+    pass
+
+def _llama_api():
+    """Resolve the adapter functions; their names changed between llama-cpp-python releases"""
+    import llama_cpp
+    if hasattr(llama_cpp, 'llama_adapter_lora_init'):
+        return (llama_cpp.llama_adapter_lora_init, llama_cpp.llama_set_adapter_lora,
+                llama_cpp.llama_clear_adapter_lora, llama_cpp.llama_adapter_lora_free)
+    if hasattr(llama_cpp, 'llama_lora_adapter_init'):
+        return (llama_cpp.llama_lora_adapter_init, llama_cpp.llama_lora_adapter_set,
+                llama_cpp.llama_lora_adapter_clear, llama_cpp.llama_lora_adapter_free)
+    raise LoraError('This llama-cpp-python build does not support runtime LoRA adapters')
+
+class LoraManager:
+    """LoRA adapters registered against the resident base model.
+
+    Registration only records the file; adapter weights are loaded on first use
+    and kept in an LRU of LORA_CACHE_SIZE entries. Switching adapters is a
+    couple of llama.cpp calls plus a KV-cache reset, instead of reloading the
+    base model. All methods that touch the model must run under the inference
+    lock.
+
+    Each registration records the base model it was trained for; only those
+    matching `base_model` are kept, so an adapter is never applied to a
+    different model after a switch.
+    """
+
+    def __init__(self, max_loaded=LORA_CACHE_SIZE):
+        self.max_loaded = max_loaded
+        self.registered = {}
+        self.base_model = None
+        self.active = None
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, name, path, scale=1.0, base_model=None):
+        with self._lock:
+            if base_model != self.base_model:
+                raise LoraError(f'Adapter {name} is for {base_model}, the loaded base model is {self.base_model}')
+            self.registered[name] = {'name': name, 'path': path, 'scale': float(scale), 'base_model': base_model}
+
+    def set_base_model(self, base_model):
+        """Forget registrations for any other base model; call after release_all when the main model changes"""
+        with self._lock:
+            self.base_model = base_model
+            self.registered = {name: info for name, info in self.registered.items()
+                               if info['base_model'] == base_model}
+
+    def unregister(self, model, name):
+        with self._lock:
+            if name not in self.registered:
+                return False
+            del self.registered[name]
+        self._evict(model, name)
+        return True
+
+    def _evict(self, model, name):
+        handle = self._loaded.pop(name, None)
+        if handle is None:
+            return
+        _, _, clear, free = _llama_api()
+        if self.active == name and model is not None:
+            clear(model.ctx)
+            model.reset()
+            self.active = None
+        free(handle)
+
+    def _load(self, model, name):
+        handle = self._loaded.get(name)
+        if handle is not None:
+            self._loaded.move_to_end(name)
+            return handle
+        init, _, _, _ = _llama_api()
+        path = self.registered[name]['path']
+        handle = init(model.model, path.encode('utf-8'))
+        if not handle:
+            raise LoraError(f'Failed to load LoRA adapter {name} from {path}')
+        self._loaded[name] = handle
+        while len(self._loaded) > self.max_loaded:
+            oldest = next(loaded for loaded in self._loaded if loaded not in (name, self.active))
+            self._evict(model, oldest)
+        return handle
+
+    def activate(self, model, name):
+        """Apply adapter `name` (None for the plain base model) to the model's context"""
+        if name == self.active:
+            return
+        if name is not None and name not in self.registered:
+            raise LoraError(f'Unknown LoRA adapter: {name}')
+        _, set_adapter, clear, _ = _llama_api()
+        clear(model.ctx)
+        self.active = None
+        if name is not None:
+            handle = self._load(model, name)
+            if set_adapter(model.ctx, handle, self.registered[name]['scale']) != 0:
+                model.reset()
+                raise LoraError(f'Failed to apply LoRA adapter {name}')
+        self.active = name
+        # The cached prompt prefix was computed with other weights
+        model.reset()
+
+    def release_all(self, model):
+        """Free every adapter; call before the base model is unloaded"""
+        if not self._loaded:
+            self.active = None
+            return
+        _, _, clear, free = _llama_api()
+        if model is not None:
+            clear(model.ctx)
+        for handle in self._loaded.values():
+            free(handle)
+        self._loaded.clear()
+        self.active = None
+
+    def status(self):
+        return {
+            'adapters': [dict(info, loaded=name in self._loaded) for name, info in self.registered.items()],
+            'active': self.active,
+            'base_model': self.base_model,
+            'max_loaded': self.max_loaded
+        }
@@ -0,0 +1,180 @@
+import os
+import time
+import threading
+from datetime import datetime
+
+QUOTA_ENABLED = os.getenv('QUOTA_ENABLED', 'true').lower() == 'true'
+QUOTA_REQUESTS_PER_MINUTE = float(os.getenv('QUOTA_REQUESTS_PER_MINUTE', 30))
+QUOTA_REQUEST_BURST = float(os.getenv('QUOTA_REQUEST_BURST', 10))
+QUOTA_TOKENS_PER_HOUR = float(os.getenv('QUOTA_TOKENS_PER_HOUR', 100000))
+QUOTA_TOKEN_BURST = float(os.getenv('QUOTA_TOKEN_BURST', 20000))
+QUOTA_MAX_TOKENS_PER_REQUEST = int(os.getenv('QUOTA_MAX_TOKENS_PER_REQUEST', 2048))
+QUOTA_SHARED_STORE = os.getenv('QUOTA_SHARED_STORE', 'false').lower() == 'true'
+# How often idle, fully refilled buckets are dropped from memory
+QUOTA_SWEEP_INTERVAL = float(os.getenv('QUOTA_SWEEP_INTERVAL', 60))
+
+class TokenBucket:
+    """Classic token bucket; balance may go negative when usage is charged after the fact"""
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def retry_after(self, amount):
+        self._refill()
+        if self.tokens >= amount:
+            return 0
+        if self.refill_per_second <= 0:
+            return float('inf')
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class MongoQuotaStore:
+    """Fixed-window counters in a shared collection so several backends enforce one budget"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+
+    def incr(self, key, window_seconds, amount):
+        window = int(time.time() // window_seconds)
+        doc = self.collection.find_one_and_update(
+            {'_id': f"{key}:{window_seconds}:{window}"},
+            {'$inc': {'count': amount},
+             '$setOnInsert': {'expires_at': datetime.utcfromtimestamp((window + 2) * window_seconds)}},
+            upsert=True,
+            return_document=True
+        )
+        return doc['count'], window_seconds - (time.time() % window_seconds)
+
+    def get(self, key, window_seconds):
+        window = int(time.time() // window_seconds)
+        doc = self.collection.find_one({'_id': f"{key}:{window_seconds}:{window}"})
+        return (doc or {}).get('count', 0), window_seconds - (time.time() % window_seconds)
+
+class QuotaExceeded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class QuotaManager:
+    """Per (user, model) request-rate and generated-token budgets"""
+
+    def __init__(self, requests_per_minute=QUOTA_REQUESTS_PER_MINUTE, request_burst=QUOTA_REQUEST_BURST,
+                 tokens_per_hour=QUOTA_TOKENS_PER_HOUR, token_burst=QUOTA_TOKEN_BURST,
+                 max_tokens_per_request=QUOTA_MAX_TOKENS_PER_REQUEST, store=None):
+        self.requests_per_minute = requests_per_minute
+        self.request_burst = request_burst
+        self.tokens_per_hour = tokens_per_hour
+        self.token_burst = token_burst
+        self.max_tokens_per_request = max_tokens_per_request
+        self.store = store
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def _sweep(self):
+        """Forget buckets that are back at capacity; recreating them later is equivalent"""
+        now = time.monotonic()
+        if now - self._last_sweep < QUOTA_SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for key in [key for key, buckets in self._buckets.items() if all(b.is_full() for b in buckets)]:
+            del self._buckets[key]
+
+    def _get_buckets(self, key):
+        self._sweep()
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            buckets = (
+                TokenBucket(self.request_burst, self.requests_per_minute / 60.0),
+                TokenBucket(self.token_burst, self.tokens_per_hour / 3600.0)
+            )
+            self._buckets[key] = buckets
+        return buckets
+
+    def clamp_max_tokens(self, max_tokens):
+        return max(1, min(int(max_tokens), self.max_tokens_per_request))
+
+    def acquire(self, user, model):
+        """Admit one request or raise QuotaExceeded; call before taking an inference slot"""
+        key = f"{user}|{model}"
+        with self._lock:
+            request_bucket, token_bucket = self._get_buckets(key)
+            wait = request_bucket.retry_after(1)
+            if wait > 0:
+                raise QuotaExceeded('Request rate limit exceeded', wait)
+            # Token debt from earlier responses must be repaid before a new request starts
+            wait = token_bucket.retry_after(1)
+            if wait > 0:
+                raise QuotaExceeded('Token budget exhausted', wait)
+            request_bucket.consume(1)
+
+        if self.store is not None:
+            count, reset = self.store.incr(f"req|{key}", 60, 1)
+            if count > self.requests_per_minute:
+                raise QuotaExceeded('Request rate limit exceeded', reset)
+            self._check_shared_tokens(key)
+
+    def check_tokens(self, user, model):
+        """Raise QuotaExceeded while the token budget is spent, without taking a request slot.
+
+        For work admitted once but generated in many steps, such as batch items.
+        """
+        key = f"{user}|{model}"
+        with self._lock:
+            wait = self._get_buckets(key)[1].retry_after(1)
+        if wait > 0:
+            raise QuotaExceeded('Token budget exhausted', wait)
+        if self.store is not None:
+            self._check_shared_tokens(key)
+
+    def _check_shared_tokens(self, key):
+        used, reset = self.store.get(f"tok|{key}", 3600)
+        if used >= self.tokens_per_hour:
+            raise QuotaExceeded('Token budget exhausted', reset)
+
+    def record_usage(self, user, model, tokens):
+        """Charge generated tokens once the handler knows the real usage"""
+        if not tokens:
+            return
+        key = f"{user}|{model}"
+        with self._lock:
+            self._get_buckets(key)[1].consume(tokens)
+        if self.store is not None:
+            self.store.incr(f"tok|{key}", 3600, tokens)
+
+    def status(self, user, model):
+        key = f"{user}|{model}"
+        with self._lock:
+            # Looking up a status must not allocate buckets for arbitrary keys
+            buckets = self._buckets.get(key)
+            if buckets is None:
+                return {
+                    'requests_remaining': int(self.request_burst),
+                    'tokens_remaining': int(self.token_burst),
+                    'max_tokens_per_request': self.max_tokens_per_request
+                }
+            request_bucket, token_bucket = buckets
+            request_bucket._refill()
+            token_bucket._refill()
+            return {
+                'requests_remaining': max(0, int(request_bucket.tokens)),
+                'tokens_remaining': int(token_bucket.tokens),
+                'max_tokens_per_request': self.max_tokens_per_request
+            }
@@ -0,0 +1,305 @@
+"""Chat-affinity router in front of several backend processes.
+
+    ROUTER_BACKENDS=http://localhost:5001,http://localhost:5002 python router.py
+
+Start the backends with TRUSTED_PROXY_COUNT=1 so they see each client's
+address (from X-Forwarded-For) rather than the router's.
+
+Conversations stick to the node that already holds their context (consistent
+hashing on chat_id with bounded load), GGUF requests prefer nodes that have the
+requested model resident, and nodes that fail /api/health are skipped until
+they recover.
+"""
+import os
+import re
+import math
+import time
+import bisect
+import hashlib
+import threading
+import requests
+from urllib3.exceptions import ConnectTimeoutError
+from flask import Flask, request, jsonify, Response, stream_with_context
+from flask_cors import CORS
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROUTER_BACKENDS = [url.strip().rstrip('/') for url in
+                   os.getenv('ROUTER_BACKENDS', 'http://localhost:5001').split(',') if url.strip()]
+ROUTER_PORT = int(os.getenv('ROUTER_PORT', 5100))
+# Virtual nodes per backend on the hash ring
+ROUTER_VNODES = int(os.getenv('ROUTER_VNODES', 100))
+# A node takes at most LOAD_FACTOR x the average in-flight requests before keys spill over
+ROUTER_LOAD_FACTOR = float(os.getenv('ROUTER_LOAD_FACTOR', 1.25))
+ROUTER_HEALTH_INTERVAL = float(os.getenv('ROUTER_HEALTH_INTERVAL', 5))
+ROUTER_CONNECT_TIMEOUT = float(os.getenv('ROUTER_CONNECT_TIMEOUT', 3))
+ROUTER_READ_TIMEOUT = float(os.getenv('ROUTER_READ_TIMEOUT', 600))
+
+# Hop-by-hop headers are never forwarded
+HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+               'te', 'trailers', 'transfer-encoding', 'upgrade', 'host', 'content-length'}
+# Jobs live on the node that accepted them
+JOB_PATH = re.compile(r'^api/(batch|model/download)/([^/]+)')
+# Requests every node must see
+BROADCAST_PATHS = {'api/chat/cancel'}
+# Safe to send again to another node even if the first one may have received it
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+class Node:
+    def __init__(self, url):
+        self.url = url
+        self.healthy = False
+        self.models = set()
+        self.inflight = 0
+        self.failures = 0
+        self.last_check = None
+        self.last_error = None
+
+    def status(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'models': sorted(self.models),
+            'inflight': self.inflight,
+            'failures': self.failures,
+            'last_check': self.last_check,
+            'last_error': self.last_error
+        }
+
+class Router:
+    """Consistent hashing with bounded loads over the healthy backend nodes"""
+
+    def __init__(self, urls, vnodes=ROUTER_VNODES, load_factor=ROUTER_LOAD_FACTOR):
+        self.nodes = {url: Node(url) for url in urls}
+        self.load_factor = load_factor
+        self.ring = sorted((_hash(f'{url}#{i}'), url) for url in urls for i in range(vnodes))
+        self.ring_keys = [point for point, _ in self.ring]
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def candidates(self, key=None, model=None):
+        """Healthy nodes in the order to try them for this key"""
+        with self._lock:
+            healthy = [node for node in self.nodes.values() if node.healthy]
+            if model:
+                resident = [node for node in healthy if model in node.models]
+                healthy = resident or healthy
+            if not healthy:
+                return []
+            if key is None:
+                return sorted(healthy, key=lambda node: node.inflight)
+            allowed = {node.url for node in healthy}
+            total = sum(node.inflight for node in healthy)
+            capacity = math.ceil(self.load_factor * (total + 1) / len(healthy))
+            order = []
+            start = bisect.bisect(self.ring_keys, _hash(key))
+            for i in range(len(self.ring)):
+                url = self.ring[(start + i) % len(self.ring)][1]
+                if url in allowed and url not in order:
+                    order.append(url)
+                    if len(order) == len(allowed):
+                        break
+            ordered = [self.nodes[url] for url in order]
+            # The first node on the ring with spare capacity goes first; the rest are failover
+            under = [node for node in ordered if node.inflight < capacity]
+            return under + [node for node in ordered if node not in under]
+
+    def acquire(self, node):
+        with self._lock:
+            node.inflight += 1
+
+    def release(self, node):
+        with self._lock:
+            node.inflight -= 1
+
+    def mark_down(self, node, error):
+        node.healthy = False
+        node.failures += 1
+        node.last_error = str(error)
+
+    def check(self, node):
+        try:
+            response = requests.get(f'{node.url}/api/health', timeout=ROUTER_CONNECT_TIMEOUT)
+            health = response.json()
+            node.healthy = response.status_code == 200 and health.get('status') == 'healthy'
+            node.models = {name for name in (health.get('model_name'), health.get('embedding_model_name')) if name}
+            node.last_error = None if node.healthy else f'HTTP {response.status_code}'
+        except Exception as e:
+            self.mark_down(node, e)
+        node.last_check = time.time()
+
+    def check_all(self):
+        threads = [threading.Thread(target=self.check, args=(node,)) for node in self.nodes.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_health_checks(self, interval=ROUTER_HEALTH_INTERVAL):
+        while True:
+            self.check_all()
+            time.sleep(interval)
+
+    def remember_job(self, job_id, node):
+        with self._lock:
+            self.jobs[job_id] = node.url
+
+    def job_node(self, job_id):
+        url = self.jobs.get(job_id)
+        node = self.nodes.get(url) if url else None
+        return node if node is not None and node.healthy else None
+
+def routing_key(path, body):
+    """Affinity key: the chat, else the conversation prefix, else the user"""
+    chat_id = body.get('chat_id') or request.args.get('chat_id')
+    if chat_id:
+        return f'chat:{chat_id}'
+    user = (body.get('user_email') or request.args.get('user_email')
+            or request.headers.get('Authorization'))
+    messages = body.get('messages')
+    if path == 'api/chat/completions' and isinstance(messages, list) and messages:
+        # Turns of the same conversation share their first message
+        return f'conv:{user}:{messages[0].get("content") if isinstance(messages[0], dict) else messages[0]}'
+    if user:
+        return f'user:{user}'
+    return None
+
+def requested_model(path, body):
+    if path == 'api/chat/completions' and body.get('model_type', 'gguf') != 'gguf':
+        return None
+    return body.get('model') or body.get('model_name')
+
+def never_connected(error):
+    """True when the TCP connection was refused or timed out, so the node never saw the request"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+app = Flask(__name__)
+# Same origins as the backends; preflight requests are answered here
+CORS(app, origins=["http://localhost:5173", "http://127.0.0.1:5173"], supports_credentials=True)
+router = Router(ROUTER_BACKENDS)
+
+def forward(node, path):
+    headers = {key: value for key, value in request.headers.items() if key.lower() not in HOP_HEADERS}
+    # Otherwise requests asks for gzip on the client's behalf and the body is relayed undecoded
+    headers.setdefault('Accept-Encoding', 'identity')
+    # Backends with TRUSTED_PROXY_COUNT=1 take the client address from the last entry, the one added here
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    headers['X-Forwarded-For'] = f'{forwarded_for}, {request.remote_addr}' if forwarded_for else request.remote_addr
+    headers['X-Forwarded-Proto'] = request.scheme
+    headers['X-Forwarded-Host'] = request.host
+    return requests.request(
+        request.method,
+        f'{node.url}/{path}',
+        params=request.args,
+        data=request.get_data(),
+        headers=headers,
+        stream=True,
+        allow_redirects=False,
+        timeout=(ROUTER_CONNECT_TIMEOUT, ROUTER_READ_TIMEOUT)
+    )
+
+def relay(node, upstream):
+    """Stream the backend response through unchanged (SSE and compressed bodies included)"""
+    def body():
+        try:
+            for chunk in upstream.raw.stream(64 * 1024, decode_content=False):
+                yield chunk
+        finally:
+            upstream.close()
+            router.release(node)
+    # The router's own server sets Server and Date
+    headers = [(key, value) for key, value in upstream.raw.headers.items()
+               if (key.lower() not in HOP_HEADERS or key.lower() == 'content-length')
+               and key.lower() not in ('server', 'date')]
+    headers.append(('X-Routed-To', node.url))
+    return Response(stream_with_context(body()), status=upstream.status_code, headers=headers)
+
+def broadcast(path):
+    last = None
+    for node in router.candidates():
+        try:
+            response = forward(node, path)
+            data, status = response.content, response.status_code
+            response.close()
+        except requests.RequestException as e:
+            router.mark_down(node, e)
+            continue
+        last = (data, status, response.headers.get('Content-Type'))
+        if status == 200:
+            break
+    if last is None:
+        return jsonify({'error': 'No healthy backend available'}), 503
+    return Response(last[0], status=last[1], content_type=last[2])
+
+@app.route('/router/status', methods=['GET'])
+def router_status():
+    return jsonify({
+        'nodes': [node.status() for node in router.nodes.values()],
+        'load_factor': router.load_factor,
+        'tracked_jobs': len(router.jobs)
+    }), 200
+
+@app.route('/api/<path:subpath>', methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH'])
+def proxy(subpath):
+    path = f'api/{subpath}'
+    if path in BROADCAST_PATHS:
+        return broadcast(path)
+    body = request.get_json(silent=True) if request.is_json else None
+    body = body if isinstance(body, dict) else {}
+
+    job = JOB_PATH.match(path)
+    pinned = router.job_node(job.group(2)) if job else None
+    if job and pinned is None and job.group(2) in router.jobs:
+        return jsonify({'error': 'The node running this job is unavailable'}), 503
+    nodes = [pinned] if pinned else router.candidates(routing_key(path, body), requested_model(path, body))
+    if not nodes:
+        return jsonify({'error': 'No healthy backend available'}), 503
+
+    for node in nodes:
+        router.acquire(node)
+        try:
+            upstream = forward(node, path)
+        except requests.ConnectionError as e:
+            router.release(node)
+            router.mark_down(node, e)
+            # A reset after connecting may come after the node acted on a POST,
+            # so only a refused connection or an idempotent method fails over
+            if not never_connected(e) and request.method not in IDEMPOTENT_METHODS:
+                return jsonify({'error': f'Backend connection lost: {e}'}), 502
+            print(f"⚠️  {node.url} unreachable, failing over: {e}")
+            continue
+        except requests.RequestException as e:
+            router.release(node)
+            return jsonify({'error': f'Backend request failed: {e}'}), 502
+        if request.method == 'POST' and path in ('api/batch', 'api/model/download') and upstream.status_code < 300:
+            data = upstream.json()
+            upstream.close()
+            router.release(node)
+            job_id = data.get('job_id') or data.get('id')
+            if job_id:
+                router.remember_job(job_id, node)
+            response = jsonify(data)
+            response.status_code = upstream.status_code
+            response.headers['X-Routed-To'] = node.url
+            return response
+        return relay(node, upstream)
+    return jsonify({'error': 'All backends failed'}), 502
+
+if __name__ == '__main__':
+    router.check_all()
+    threading.Thread(target=router.run_health_checks, name='router-health', daemon=True).start()
+    print("\n" + "="*60)
+    print("CHAT ROUTER")
+    print("="*60)
+    for node in router.nodes.values():
+        print(f"{node.url}: {'✓ healthy' if node.healthy else '✗ down'}")
+    print(f"Router URL: http://localhost:{ROUTER_PORT}")
+    print("="*60 + "\n")
+    app.run(host='0.0.0.0', port=ROUTER_PORT, threaded=True)
@@ -0,0 +1,99 @@
+import os
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SPECULATIVE_DRAFT_TOKENS = int(os.getenv('SPECULATIVE_DRAFT_TOKENS', 8))
+SPECULATIVE_MAX_DRAFT_TOKENS = 32
+
+class GGUFDraftModel:
+    """Draft proposer backed by a small GGUF model.
+
+    Follows llama_cpp's LlamaDraftModel call protocol without importing
+    llama_cpp at startup. llama-cpp-python calls the draft model with the main
+    model's token history; we greedily extend it by `num_pred_tokens` and the
+    main model verifies the whole run in one batch. Acceptance is measured exactly by comparing each
+    proposal with the tokens that show up in the next call's history.
+    """
+
+    def __init__(self, llama, model_name, num_pred_tokens=SPECULATIVE_DRAFT_TOKENS):
+        self.llama = llama
+        self.model_name = model_name
+        self.num_pred_tokens = num_pred_tokens
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.draft_calls = 0
+        self.proposed_tokens = 0
+        self.accepted_tokens = 0
+        self._last_history_len = None
+        self._last_proposal = None
+
+    def _score_previous_proposal(self, input_ids):
+        if self._last_proposal is None or self._last_history_len is None:
+            return
+        appended = input_ids[self._last_history_len:]
+        accepted = 0
+        for drafted, actual in zip(self._last_proposal, appended):
+            if drafted != actual:
+                break
+            accepted += 1
+        self.proposed_tokens += len(self._last_proposal)
+        self.accepted_tokens += accepted
+
+    def finish(self, output_ids):
+        """Score the final proposal against the tokens the main model produced"""
+        if output_ids is not None:
+            self._score_previous_proposal(list(output_ids))
+        self._last_proposal = None
+
+    def stats(self):
+        proposed = self.proposed_tokens
+        return {
+            'draft_model': self.model_name,
+            'draft_tokens': self.num_pred_tokens,
+            'draft_calls': self.draft_calls,
+            'proposed_tokens': proposed,
+            'accepted_tokens': self.accepted_tokens,
+            'acceptance_rate': round(self.accepted_tokens / proposed, 4) if proposed else 0.0
+        }
+
+    def __call__(self, input_ids, **kwargs):
+        with self._lock:
+            history = [int(t) for t in input_ids]
+            self._score_previous_proposal(history)
+            self.draft_calls += 1
+
+            draft = self.llama
+            # Reuse the draft KV cache for the shared prefix, evaluate only the new tail
+            prefix = 0
+            cached = draft.input_ids[:draft.n_tokens]
+            for cached_token, token in zip(cached, history):
+                if cached_token != token:
+                    break
+                prefix += 1
+            prefix = min(prefix, len(history) - 1)
+            draft.n_tokens = prefix
+            draft.eval(history[prefix:])
+
+            proposal = []
+            for _ in range(self.num_pred_tokens):
+                if draft.n_tokens >= draft.n_ctx():
+                    break
+                logits = draft.scores[draft.n_tokens - 1, :]
+                token = int(np.argmax(logits))
+                if token == draft.token_eos():
+                    break
+                proposal.append(token)
+                draft.eval([token])
+
+            self._last_history_len = len(history)
+            self._last_proposal = proposal
+            return np.array(proposal, dtype=np.intc)
+
+def clamp_draft_tokens(value):
+    return max(1, min(int(value), SPECULATIVE_MAX_DRAFT_TOKENS))
@@ -0,0 +1,74 @@
+import os
+import json
+import mmap
+import threading
+
+# Comma-separated GGUF files to preload; the first becomes the active model,
+# the rest are only paged into memory so switching to them later is fast
+PRELOAD_MODELS = [m.strip() for m in os.getenv('PRELOAD_MODELS', '').split(',') if m.strip()]
+PRELOAD_DRAFT_MODEL = os.getenv('PRELOAD_DRAFT_MODEL', '').strip() or None
+PRELOAD_N_CTX = int(os.getenv('PRELOAD_N_CTX', os.getenv('DEFAULT_N_CTX', 2048)))
+PRELOAD_N_GPU_LAYERS = int(os.getenv('PRELOAD_N_GPU_LAYERS', os.getenv('DEFAULT_N_GPU_LAYERS', 0)))
+# Reload whatever was loaded before the last shutdown when PRELOAD_MODELS is empty
+PRELOAD_FROM_SNAPSHOT = os.getenv('PRELOAD_FROM_SNAPSHOT', 'true').lower() == 'true'
+STARTUP_SNAPSHOT = os.getenv('STARTUP_SNAPSHOT', os.path.join('models', '.startup_snapshot.json'))
+
+_snapshot_lock = threading.Lock()
+
+def warm_model_file(filepath):
+    """Memory-map a model file and touch every page so the later load hits the page cache"""
+    size = os.path.getsize(filepath)
+    if size == 0:
+        return 0
+    with open(filepath, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+                mapped.madvise(mmap.MADV_WILLNEED)
+            checksum = 0
+            for offset in range(0, size, mmap.PAGESIZE):
+                checksum ^= mapped[offset]
+    return size
+
+def read_snapshot():
+    try:
+        with open(STARTUP_SNAPSHOT, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def record_snapshot(role, model_name, n_ctx=None, n_gpu_layers=None):
+    """Remember the resident models so the next boot can preload them"""
+    with _snapshot_lock:
+        snapshot = read_snapshot()
+        if model_name:
+            snapshot[role] = {'model_name': model_name, 'n_ctx': n_ctx, 'n_gpu_layers': n_gpu_layers}
+        else:
+            snapshot.pop(role, None)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(STARTUP_SNAPSHOT)), exist_ok=True)
+            tmp_path = STARTUP_SNAPSHOT + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, STARTUP_SNAPSHOT)
+        except OSError as e:
+            print(f"⚠️  Could not write startup snapshot: {e}")
+
+def get_preload_plan():
+    """Return a list of (role, model_name, n_ctx, n_gpu_layers) to load at boot"""
+    plan = []
+    if PRELOAD_MODELS:
+        plan.append(('main', PRELOAD_MODELS[0], PRELOAD_N_CTX, PRELOAD_N_GPU_LAYERS))
+        plan.extend(('warm', name, None, None) for name in PRELOAD_MODELS[1:])
+        if PRELOAD_DRAFT_MODEL:
+            plan.append(('draft', PRELOAD_DRAFT_MODEL, PRELOAD_N_CTX, PRELOAD_N_GPU_LAYERS))
+    elif PRELOAD_FROM_SNAPSHOT:
+        snapshot = read_snapshot()
+        for role in ('main', 'draft', 'embedding'):
+            entry = snapshot.get(role)
+            if entry and entry.get('model_name'):
+                plan.append((role, entry['model_name'],
+                             entry.get('n_ctx') or PRELOAD_N_CTX,
+                             entry.get('n_gpu_layers') or 0))
+    # Draft first, so the main model is built with logits_all once instead of being reloaded
+    plan.sort(key=lambda entry: entry[0] != 'draft')
+    return plan
@@ -0,0 +1,361 @@
+import os
+import json
+import uuid
+import base64
+import sqlite3
+import threading
+from datetime import datetime
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mongo').lower()
+# Backend to fall back to when the primary one is unreachable at startup (e.g. 'sqlite')
+STORAGE_FALLBACK = os.getenv('STORAGE_FALLBACK', '').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', os.path.join('data', 'chatbot.db'))
+
+COLLECTIONS = ('users', 'chats', 'models', 'nodes', 'counters', 'usage')
+
+class DuplicateKeyError(Exception):
+    pass
+
+class UpdateOne:
+    """Backend-neutral update for bulk_update()"""
+
+    def __init__(self, filter_doc, update, upsert=False):
+        self.filter = filter_doc
+        self.update = update
+        self.upsert = upsert
+
+class StorageResult:
+    """Mirrors the pymongo result attributes the app reads"""
+
+    def __init__(self, inserted_id=None, matched_count=0, modified_count=0, deleted_count=0, upserted_id=None):
+        self.inserted_id = inserted_id
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.deleted_count = deleted_count
+        self.upserted_id = upserted_id
+
+# ==================== DOCUMENT ENCODING ====================
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    if isinstance(value, bytes):
+        return {'$binary': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, dict):
+        return {key: _encode_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(item) for item in value]
+    return value
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if len(value) == 1 and '$date' in value:
+            return datetime.fromisoformat(value['$date'])
+        if len(value) == 1 and '$binary' in value:
+            return base64.b64decode(value['$binary'])
+        return {key: _decode_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode_value(item) for item in value]
+    return value
+
+def _field_sql(field):
+    """SQL expression for a top-level document field; dates compare by their ISO string"""
+    if field == '_id':
+        return 'id'
+    path = field.replace('"', '')
+    return f"COALESCE(json_extract(doc, '$.\"{path}\".\"$date\"'), json_extract(doc, '$.\"{path}\"'))"
+
+RANGE_OPERATORS = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+def _query_value(field, value):
+    encoded = _encode_value(value)
+    if isinstance(encoded, dict):
+        encoded = encoded.get('$date', json.dumps(encoded))
+    if field == '_id':
+        encoded = str(encoded)
+    return encoded
+
+def _where(filter_doc):
+    clauses = []
+    params = []
+    for field, value in (filter_doc or {}).items():
+        if isinstance(value, dict):
+            for operator, operand in value.items():
+                if operator == '$in':
+                    operand = list(operand)
+                    clauses.append(f"{_field_sql(field)} IN ({', '.join('?' * len(operand))})" if operand else '0')
+                    params.extend(_query_value(field, item) for item in operand)
+                    continue
+                if operator not in RANGE_OPERATORS:
+                    raise ValueError(f'Unsupported query operator on {field}: {operator}')
+                clauses.append(f'{_field_sql(field)} {RANGE_OPERATORS[operator]} ?')
+                params.append(_query_value(field, operand))
+            continue
+        if value is None:
+            clauses.append(f'{_field_sql(field)} IS NULL')
+            continue
+        clauses.append(f'{_field_sql(field)} = ?')
+        params.append(_query_value(field, value))
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+def apply_update(doc, update, inserting=False):
+    """Apply $set / $inc / $setOnInsert / $unset to a document in place"""
+    for operator, fields in update.items():
+        if operator == '$set':
+            doc.update(fields)
+        elif operator == '$inc':
+            for field, amount in fields.items():
+                doc[field] = doc.get(field, 0) + amount
+        elif operator == '$setOnInsert':
+            if inserting:
+                doc.update(fields)
+        elif operator == '$unset':
+            for field in fields:
+                doc.pop(field, None)
+        else:
+            raise ValueError(f'Unsupported update operator: {operator}')
+    return doc
+
+# ==================== SQLITE BACKEND ====================
+
+class SQLiteCursor:
+    def __init__(self, collection, filter_doc):
+        self.collection = collection
+        self.filter_doc = filter_doc
+        self.order = []
+        self.limit_count = None
+
+    def sort(self, key, direction=1):
+        self.order.append((key, direction))
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def __iter__(self):
+        where, params = _where(self.filter_doc)
+        sql = f'SELECT id, doc FROM "{self.collection.name}"{where}'
+        if self.order:
+            sql += ' ORDER BY ' + ', '.join(
+                f"{_field_sql(key)} {'DESC' if direction < 0 else 'ASC'}" for key, direction in self.order)
+        if self.limit_count:
+            sql += f' LIMIT {int(self.limit_count)}'
+        rows = self.collection.db.connection().execute(sql, params).fetchall()
+        return iter([self.collection._row_to_doc(row) for row in rows])
+
+class SQLiteCollection:
+    """The subset of pymongo's Collection API used by the app, on one SQLite table.
+
+    Documents are stored as JSON; only top-level equality, range
+    ($gt/$gte/$lt/$lte) and $in filters and $set/$inc/$setOnInsert/$unset
+    updates are supported.
+    """
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.db.connection().execute(
+            f'CREATE TABLE IF NOT EXISTS "{name}" (id TEXT PRIMARY KEY, doc TEXT NOT NULL)')
+
+    def _row_to_doc(self, row):
+        doc = _decode_value(json.loads(row[1]))
+        doc['_id'] = row[0]
+        return doc
+
+    def _write(self, conn, doc_id, doc, insert):
+        body = dict(doc)
+        body.pop('_id', None)
+        payload = json.dumps(_encode_value(body))
+        try:
+            if insert:
+                conn.execute(f'INSERT INTO "{self.name}" (id, doc) VALUES (?, ?)', (doc_id, payload))
+            else:
+                conn.execute(f'UPDATE "{self.name}" SET doc = ? WHERE id = ?', (payload, doc_id))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e))
+
+    def create_index(self, key, unique=False, **kwargs):
+        # TTL (expireAfterSeconds) and other Mongo index options are ignored
+        field = key if isinstance(key, str) else key[0][0]
+        if field == '_id':
+            return
+        index_name = f'idx_{self.name}_{field}'
+        self.db.connection().execute(
+            f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS "{index_name}" '
+            f'ON "{self.name}" ({_field_sql(field)})')
+        return index_name
+
+    def find_one(self, filter_doc=None):
+        for doc in SQLiteCursor(self, filter_doc).limit(1):
+            return doc
+        return None
+
+    def find(self, filter_doc=None):
+        return SQLiteCursor(self, filter_doc)
+
+    def count_documents(self, filter_doc):
+        where, params = _where(filter_doc)
+        return self.db.connection().execute(f'SELECT COUNT(*) FROM "{self.name}"{where}', params).fetchone()[0]
+
+    def insert_one(self, doc):
+        doc_id = str(doc.get('_id') or uuid.uuid4().hex)
+        with self.db.transaction() as conn:
+            self._write(conn, doc_id, doc, insert=True)
+        doc['_id'] = doc_id
+        return StorageResult(inserted_id=doc_id)
+
+    def update_one(self, filter_doc, update, upsert=False):
+        with self.db.transaction() as conn:
+            return self._update_one(conn, filter_doc, update, upsert)[0]
+
+    def _update_one(self, conn, filter_doc, update, upsert):
+        where, params = _where(filter_doc)
+        row = conn.execute(f'SELECT id, doc FROM "{self.name}"{where} LIMIT 1', params).fetchone()
+        if row is None:
+            if not upsert:
+                return StorageResult(), None
+            doc = {key: value for key, value in filter_doc.items() if not isinstance(value, dict)}
+            apply_update(doc, update, inserting=True)
+            doc_id = str(doc.pop('_id', None) or uuid.uuid4().hex)
+            self._write(conn, doc_id, doc, insert=True)
+            doc['_id'] = doc_id
+            return StorageResult(upserted_id=doc_id), doc
+        doc = self._row_to_doc(row)
+        before = json.dumps(_encode_value(doc), sort_keys=True)
+        apply_update(doc, update)
+        changed = json.dumps(_encode_value(doc), sort_keys=True) != before
+        if changed:
+            self._write(conn, row[0], doc, insert=False)
+        return StorageResult(matched_count=1, modified_count=1 if changed else 0), doc
+
+    def find_one_and_update(self, filter_doc, update, upsert=False, return_document=False):
+        with self.db.transaction() as conn:
+            before = None
+            if not return_document:
+                where, params = _where(filter_doc)
+                row = conn.execute(f'SELECT id, doc FROM "{self.name}"{where} LIMIT 1', params).fetchone()
+                before = self._row_to_doc(row) if row else None
+            _, after = self._update_one(conn, filter_doc, update, upsert)
+        return after if return_document else before
+
+    def bulk_write(self, operations):
+        """Apply UpdateOne operations in a single transaction"""
+        modified = 0
+        upserted = 0
+        with self.db.transaction() as conn:
+            for op in operations:
+                result, _ = self._update_one(conn, op.filter, op.update, op.upsert)
+                modified += result.modified_count
+                upserted += 1 if result.upserted_id else 0
+        return StorageResult(modified_count=modified, upserted_id=upserted or None)
+
+    def delete_one(self, filter_doc):
+        where, params = _where(filter_doc)
+        with self.db.transaction() as conn:
+            cursor = conn.execute(
+                f'DELETE FROM "{self.name}" WHERE id IN (SELECT id FROM "{self.name}"{where} LIMIT 1)', params)
+        return StorageResult(deleted_count=cursor.rowcount)
+
+    def delete_many(self, filter_doc):
+        where, params = _where(filter_doc)
+        with self.db.transaction() as conn:
+            cursor = conn.execute(f'DELETE FROM "{self.name}"{where}', params)
+        return StorageResult(deleted_count=cursor.rowcount)
+
+class _Transaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        # IMMEDIATE takes the write lock up front so read-modify-write is atomic
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+class SQLiteDatabase:
+    """Embedded single-file database in WAL mode; one connection per thread"""
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._collections = {}
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    def transaction(self):
+        return _Transaction(self.connection())
+
+    def __getitem__(self, name):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = SQLiteCollection(self, name)
+                self._collections[name] = collection
+            return collection
+
+    def list_collection_names(self):
+        rows = self.connection().execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        return [row[0] for row in rows]
+
+# ==================== BACKEND SELECTION ====================
+
+def bulk_update(collection, operations):
+    """Send UpdateOne operations to a collection in one round trip on either backend"""
+    if not operations:
+        return None
+    if isinstance(collection, SQLiteCollection):
+        return collection.bulk_write(operations)
+    from pymongo import UpdateOne as MongoUpdateOne
+    return collection.bulk_write(
+        [MongoUpdateOne(op.filter, op.update, upsert=op.upsert) for op in operations],
+        ordered=False
+    )
+
+def failed_operations(error, count):
+    """Indexes of the bulk_update operations that did not apply when it raised `error`.
+
+    SQLite bulk writes are one transaction, so nothing applied. MongoDB's
+    unordered bulk_write raises BulkWriteError after applying every operation
+    except those listed in its writeErrors.
+    """
+    details = getattr(error, 'details', None)
+    if isinstance(details, dict) and 'writeErrors' in details:
+        return sorted({write_error['index'] for write_error in details['writeErrors']})
+    return list(range(count))
+
+def ensure_indexes(database):
+    database['users'].create_index('email', unique=True)
+    database['chats'].create_index('user_email')
+    database['chats'].create_index('created_at')
+    database['nodes'].create_index('user_email')
+    database['nodes'].create_index('chat_id')
+    database['usage'].create_index('bucket')
+    database['usage'].create_index('user')
+
+def open_database(backend=STORAGE_BACKEND, mongo_uri=None, db_name=None, timeout_ms=5000):
+    """Return a database object whose collections support the app's operations"""
+    if backend == 'sqlite':
+        return SQLiteDatabase(SQLITE_PATH)
+    if backend == 'mongo':
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri, serverSelectionTimeoutMS=timeout_ms)
+        # Test the connection
+        client.server_info()
+        return client[db_name]
+    raise ValueError(f'Unknown storage backend: {backend}')
@@ -0,0 +1,145 @@
+"""Storage maintenance commands.
+
+    python storage_tools.py migrate --source mongo --target sqlite
+    python storage_tools.py bench --backend sqlite --users 200 --chats 10
+    python storage_tools.py train-dict --backend sqlite --output data/messages.zdict
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import storage
+import compression
+
+MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
+DB_NAME = os.getenv('DB_NAME', 'chatbot_db')
+
+def migrate(source_backend, target_backend, collections):
+    source = storage.open_database(source_backend, MONGO_URI, DB_NAME)
+    target = storage.open_database(target_backend, MONGO_URI, DB_NAME)
+    storage.ensure_indexes(target)
+    for name in collections:
+        copied = 0
+        started = time.time()
+        for doc in source[name].find({}):
+            doc_id = str(doc.pop('_id'))
+            # Upsert by id so re-running the migration is safe
+            target[name].update_one({'_id': doc_id}, {'$set': doc}, upsert=True)
+            copied += 1
+        print(f"✓ {name}: copied {copied} documents in {time.time() - started:.2f}s")
+
+def _timed(results, label, count, fn):
+    started = time.perf_counter()
+    for i in range(count):
+        fn(i)
+    elapsed = time.perf_counter() - started
+    results.append((label, count, elapsed))
+
+def bench(database, n_users, n_chats):
+    """Replays the app's hot storage paths: signup, login lookup, chat save, history list, stats"""
+    storage.ensure_indexes(database)
+    users = database['users']
+    chats = database['chats']
+    models = database['models']
+    messages = [{'role': 'user', 'content': 'Hello ' * 50}, {'role': 'assistant', 'content': 'Hi ' * 100}]
+    results = []
+
+    _timed(results, 'signup insert_one', n_users, lambda i: users.insert_one({
+        'username': f'user{i}', 'email': f'user{i}@bench.local', 'password': 'x' * 90,
+        'profile_photo': None, 'created_at': datetime.utcnow(), 'updated_at': datetime.utcnow()}))
+    _timed(results, 'login find_one', n_users, lambda i: users.find_one({'email': f'user{i}@bench.local'}))
+    _timed(results, 'save_history upsert', n_users * n_chats, lambda i: chats.update_one(
+        {'chat_id': str(i % (n_users * n_chats)), 'user_email': f'user{i % n_users}@bench.local'},
+        {'$set': {'title': 'Bench', 'messages': messages,
+                  'created_at': datetime.utcnow(), 'updated_at': datetime.utcnow()}},
+        upsert=True))
+    _timed(results, 'list_history find+sort', n_users, lambda i: list(
+        chats.find({'user_email': f'user{i}@bench.local'}).sort('created_at', -1)))
+    _timed(results, 'model upsert', n_users, lambda i: models.update_one(
+        {'filename': f'model{i % 5}.gguf'}, {'$set': {'last_loaded': datetime.utcnow()}}, upsert=True))
+    _timed(results, 'stats count_documents', 20, lambda i: (
+        users.count_documents({}), chats.count_documents({}), models.count_documents({})))
+
+    print(f"{'operation':<26}{'ops':>8}{'total s':>10}{'ops/s':>12}{'ms/op':>10}")
+    for label, count, elapsed in results:
+        print(f"{label:<26}{count:>8}{elapsed:>10.3f}{count / elapsed:>12.0f}{elapsed * 1000 / count:>10.3f}")
+
+def train_dict(backend, output, size, limit):
+    """Train a zstd dictionary on stored messages for MessageCodec"""
+    database = storage.open_database(backend, MONGO_URI, DB_NAME)
+    codec = compression.MessageCodec()
+    samples = []
+    for chat in database['chats'].find({}):
+        for message in codec.decompress_messages(chat.get('messages')):
+            content = message.get('content') if isinstance(message, dict) else None
+            if isinstance(content, str) and content:
+                samples.append(content)
+        if len(samples) >= limit:
+            break
+    if not samples:
+        print("❌ No stored messages to train on")
+        return 1
+    data = compression.train_dictionary(samples[:limit], size)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'wb') as f:
+        f.write(data)
+    print(f"✓ Trained {len(data)} byte dictionary on {min(len(samples), limit)} messages -> {output}")
+    # Messages already compressed with an older dictionary need that dictionary to be read back
+    print("  Keep any previous dictionary file until the chats that used it have been re-saved")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Storage backend tools')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = sub.add_parser('migrate', help='Copy users/chats/models between backends')
+    migrate_parser.add_argument('--source', required=True, choices=['mongo', 'sqlite'])
+    migrate_parser.add_argument('--target', required=True, choices=['mongo', 'sqlite'])
+    migrate_parser.add_argument('--collections', default=','.join(storage.COLLECTIONS))
+
+    bench_parser = sub.add_parser('bench', help='Benchmark a backend on a scratch database')
+    bench_parser.add_argument('--backend', required=True, choices=['mongo', 'sqlite'])
+    bench_parser.add_argument('--users', type=int, default=200)
+    bench_parser.add_argument('--chats', type=int, default=10)
+
+    dict_parser = sub.add_parser('train-dict', help='Train a zstd dictionary for message compression')
+    dict_parser.add_argument('--backend', default=storage.STORAGE_BACKEND, choices=['mongo', 'sqlite'])
+    dict_parser.add_argument('--output', default=compression.COMPRESSION_DICT_PATH)
+    dict_parser.add_argument('--size', type=int, default=112640)
+    dict_parser.add_argument('--limit', type=int, default=20000, help='Maximum number of sample messages')
+
+    args = parser.parse_args()
+    if args.command == 'train-dict':
+        return train_dict(args.backend, args.output, args.size, args.limit)
+    if args.command == 'migrate':
+        if args.source == args.target:
+            parser.error('source and target must differ')
+        migrate(args.source, args.target, [c for c in args.collections.split(',') if c])
+        return
+
+    # Never benchmark against real data
+    if args.backend == 'sqlite':
+        scratch = tempfile.mkdtemp(prefix='chatbot_bench_')
+        try:
+            bench(storage.SQLiteDatabase(os.path.join(scratch, 'bench.db')), args.users, args.chats)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    else:
+        from pymongo import MongoClient
+        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        bench_db = f'{DB_NAME}_bench'
+        client.drop_database(bench_db)
+        try:
+            bench(client[bench_db], args.users, args.chats)
+        finally:
+            client.drop_database(bench_db)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+import storage
+
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'true').lower() == 'true'
+WRITE_BEHIND_WINDOW_MS = int(os.getenv('WRITE_BEHIND_WINDOW_MS', 50))
+WRITE_BEHIND_MAX_BATCH = int(os.getenv('WRITE_BEHIND_MAX_BATCH', 500))
+WRITE_BEHIND_ACK_TIMEOUT = float(os.getenv('WRITE_BEHIND_ACK_TIMEOUT', 10))
+# Failed flushes are retried with exponential backoff before the writes are dropped
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv('WRITE_BEHIND_MAX_RETRIES', 5))
+WRITE_BEHIND_RETRY_BACKOFF_MS = int(os.getenv('WRITE_BEHIND_RETRY_BACKOFF_MS', 200))
+WRITE_BEHIND_MAX_BACKOFF_MS = 30000
+
+class WriteAck:
+    """Resolved once the write it belongs to has reached the database"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.error = None
+
+    def resolve(self, error=None):
+        self.error = error
+        self._event.set()
+
+    def wait(self, timeout=WRITE_BEHIND_ACK_TIMEOUT):
+        """True if the write was flushed successfully within the timeout"""
+        return self._event.wait(timeout) and self.error is None
+
+def merge_updates(current, new):
+    """Fold a later update document into an earlier one for the same target.
+
+    A field never ends up in both $set and $setOnInsert (MongoDB rejects the
+    conflict): $set always wins, since it applies whether or not the
+    document is inserted.
+    """
+    for operator, fields in new.items():
+        target = current.setdefault(operator, {})
+        if operator == '$inc':
+            for field, amount in fields.items():
+                target[field] = target.get(field, 0) + amount
+        elif operator == '$setOnInsert':
+            for field, value in fields.items():
+                if field not in current.get('$set', {}):
+                    target.setdefault(field, value)
+        else:
+            target.update(fields)
+            if operator == '$set':
+                for field in fields:
+                    current.get('$setOnInsert', {}).pop(field, None)
+    # MongoDB also rejects empty operators
+    for operator in [operator for operator, fields in current.items() if not fields]:
+        del current[operator]
+    return current
+
+class WriteBehindQueue:
+    """Buffers upserts off the request thread and flushes them with bulk writes.
+
+    Updates to the same (collection, filter) inside one flush window are
+    coalesced into a single operation, so a chat saved on every turn costs one
+    write per window. Callers that need durability wait on the returned
+    WriteAck; readers call sync() first to see their own writes.
+
+    A failed bulk write puts its entries back in the queue, under any newer
+    update for the same document, and retries them with backoff. Acks resolve
+    only once the write lands or is dropped after the last retry.
+    """
+
+    def __init__(self, window_ms=WRITE_BEHIND_WINDOW_MS, max_batch=WRITE_BEHIND_MAX_BATCH,
+                 max_retries=WRITE_BEHIND_MAX_RETRIES, backoff_ms=WRITE_BEHIND_RETRY_BACKOFF_MS):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.backoff = backoff_ms / 1000.0
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._retry_at = None
+        self.stats = {'enqueued': 0, 'coalesced': 0, 'flushed_ops': 0, 'batches': 0,
+                      'errors': 0, 'retried_ops': 0, 'dropped_ops': 0,
+                      'last_flush_ms': 0.0, 'last_error': None}
+        self._worker = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._worker.start()
+
+    def update_one(self, collection, filter_doc, update, upsert=False):
+        if self._closed:
+            collection.update_one(filter_doc, update, upsert=upsert)
+            ack = WriteAck()
+            ack.resolve()
+            return ack
+        key = (collection.name, json.dumps(filter_doc, sort_keys=True, default=str))
+        ack = WriteAck()
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = {
+                    'collection': collection,
+                    'filter': filter_doc,
+                    'update': merge_updates({}, update),
+                    'upsert': upsert,
+                    'acks': [ack],
+                    'attempts': 0
+                }
+            else:
+                merge_updates(entry['update'], update)
+                entry['upsert'] = entry['upsert'] or upsert
+                entry['acks'].append(ack)
+                self.stats['coalesced'] += 1
+            self.stats['enqueued'] += 1
+            full = len(self._pending) >= self.max_batch
+        self._wakeup.set()
+        if full:
+            self.flush()
+        return ack
+
+    def depth(self):
+        return len(self._pending)
+
+    def retrying(self):
+        with self._lock:
+            return sum(1 for entry in self._pending.values() if entry['attempts'])
+
+    def metrics(self):
+        return dict(self.stats, depth=self.depth(), retrying=self.retrying(), window_ms=self.window * 1000)
+
+    def sync(self, collection_name=None):
+        """Flush now if anything for collection_name (or anything at all) is pending"""
+        with self._lock:
+            pending = any(collection_name is None or key[0] == collection_name for key in self._pending)
+        if pending:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = OrderedDict()
+            if not batch:
+                return
+            started = time.perf_counter()
+            by_collection = OrderedDict()
+            for key, entry in batch.items():
+                by_collection.setdefault(id(entry['collection']), []).append((key, entry))
+            failed = []
+            for items in by_collection.values():
+                collection = items[0][1]['collection']
+                operations = [storage.UpdateOne(e['filter'], e['update'], e['upsert']) for _, e in items]
+                try:
+                    storage.bulk_update(collection, operations)
+                    self.stats['flushed_ops'] += len(operations)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    self.stats['last_error'] = str(e)
+                    print(f"❌ Write-behind flush to {collection.name} failed: {e}")
+                    # Retrying operations that did apply would repeat their $inc
+                    retry = set(storage.failed_operations(e, len(items)))
+                    self.stats['flushed_ops'] += len(items) - len(retry)
+                    failed.extend((key, entry, str(e)) for index, (key, entry) in enumerate(items) if index in retry)
+                    items = [item for index, item in enumerate(items) if index not in retry]
+                for _, entry in items:
+                    for ack in entry['acks']:
+                        ack.resolve()
+            if failed:
+                self._requeue(failed)
+            self.stats['batches'] += 1
+            self.stats['last_flush_ms'] = round((time.perf_counter() - started) * 1000, 3)
+
+    def _requeue(self, failed):
+        """Put failed entries back ahead of newer updates to the same documents"""
+        attempts = 0
+        with self._lock:
+            for key, entry, error in reversed(failed):
+                entry['attempts'] += 1
+                if self._closed or entry['attempts'] > self.max_retries:
+                    self.stats['dropped_ops'] += 1
+                    print(f"❌ Write-behind dropped an update to {entry['collection'].name} "
+                          f"{entry['filter']} after {entry['attempts']} attempts")
+                    for ack in entry['acks']:
+                        ack.resolve(error)
+                    continue
+                newer = self._pending.get(key)
+                if newer is not None:
+                    # The failed update happened first, so later writes apply on top of it
+                    merge_updates(entry['update'], newer['update'])
+                    entry['upsert'] = entry['upsert'] or newer['upsert']
+                    entry['acks'].extend(newer['acks'])
+                self._pending[key] = entry
+                self._pending.move_to_end(key, last=False)
+                self.stats['retried_ops'] += 1
+                attempts = max(attempts, entry['attempts'])
+            if attempts:
+                delay = min(self.backoff * 2 ** (attempts - 1), WRITE_BEHIND_MAX_BACKOFF_MS / 1000.0)
+                self._retry_at = time.monotonic() + delay
+        if attempts:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # Let more updates for the same documents arrive before writing
+            time.sleep(self.window)
+            if self._retry_at is not None:
+                # Back off after a failed flush; readers can still force one with sync()
+                time.sleep(max(0.0, self._retry_at - time.monotonic()))
+                self._retry_at = None
+            self.flush()
+
+    def close(self):
+        """Flush everything and switch to synchronous writes; called at shutdown"""
+        self._closed = True
+        self._wakeup.set()
+        self.flush()